@@ -0,0 +1,291 @@
+import argparse
+import multiprocessing
+import os
+import time
+from collections import Counter
+import cv2
+import numpy as np
+from calibration import TableCalibration
+from core import load_balls, DATA_FILE
+from detection import BallDetector, BallTracker, MotionGate, DETECTION_SCALE, MIN_RADIUS, cue_index
+from recorder import is_rectified
+from sources import open_source, FAST
+
+# Seconds of video per chunk handed to a worker
+CHUNK_SECONDS = 60
+# Frames each chunk reads past its end, so its tracks can be matched to the next chunk's
+OVERLAP_FRAMES = 15
+# A ball is moving when it has gone further than MOVE_DISTANCE pixels in MOVE_FRAMES frames
+MOVE_DISTANCE = 3.0
+MOVE_FRAMES = 3
+# Frames without movement that end a shot
+REST_FRAMES = 15
+# Movement shorter than this many frames is detection noise, not a shot
+MIN_SHOT_FRAMES = 3
+# Tracks of neighbouring chunks are the same ball within this many radii
+STITCH_RADII = 1.0
+# Per-frame ball observations, one array per column
+TRACK_COLUMNS = ('frame', 'track', 'label', 'stripe', 'x', 'y', 'r')
+TRACK_TYPES = (np.int32, np.int32, np.int16, np.bool_, np.float32, np.float32, np.float32)
+
+
+def empty_tracks():
+    return {name: np.zeros(0, dtype) for name, dtype in zip(TRACK_COLUMNS, TRACK_TYPES)}
+
+
+def select(columns, rows):
+    return {name: values[rows] for name, values in columns.items()}
+
+
+# Split a video of count frames into (start, stop) chunks of chunkFrames
+def plan_chunks(count, chunkFrames):
+    chunkFrames = max(int(chunkFrames), 1)
+    return [(start, min(start + chunkFrames, count)) for start in range(0, count, chunkFrames)]
+
+
+def init_worker():
+    # The workers already use every core, so OpenCV should not add threads
+    cv2.setNumThreads(1)
+
+
+# Detect and track the balls of frames start to stop + overlap of a video.
+# Returns (start, stop, observations as columns, frames read, seconds taken).
+def analyze_chunk(job):
+    video, start, stop, overlap, ballObjects, white, scale, calibrationFile = job
+    began = time.perf_counter()
+    calibration = TableCalibration.load(calibrationFile) if calibrationFile else None
+    source = open_source(video, FAST, loop=False)
+    source.seek(start)
+    fps = source.get(cv2.CAP_PROP_FPS)
+    tracker = BallTracker(BallDetector(ballObjects, scale, white), MIN_RADIUS, gate=MotionGate())
+    rows = []
+    rectified = None
+    index = start
+    while index < stop + overlap:
+        ret, frame = source.read()
+        if not ret:
+            break
+        if calibration is not None:
+            frame = rectified = calibration.rectify(frame, rectified)
+        # Video time keeps the motion gate's timeout the same at any speed
+        for track in tracker.detect(frame, index / fps):
+            if track.r > MIN_RADIUS:
+                rows.append((index, track.id, track.label, track.stripe,
+                             track.x, track.y, track.r))
+        index += 1
+    source.release()
+
+    columns = empty_tracks()
+    if rows:
+        for name, dtype, values in zip(TRACK_COLUMNS, TRACK_TYPES, zip(*rows)):
+            columns[name] = np.array(values, dtype)
+    return start, stop, columns, index - start, time.perf_counter() - began
+
+
+# Give the tracks of consecutive chunks one set of ids. A chunk's tracks take
+# the ids of the previous chunk's tracks they overlap with in most frames;
+# the rest get new ids. Every chunk keeps only its own frames.
+def stitch(chunks, radii=STITCH_RADII):
+    parts = []
+    nextId = 0
+    previous = None
+    for start, stop, columns, _, _ in chunks:
+        mapping = {}
+        if previous is not None:
+            votes = overlap_votes(previous[0], columns, start, radii)
+            used = set()
+            for (old, new), _ in votes.most_common():
+                if new not in mapping and old not in used:
+                    mapping[new] = previous[1][old]
+                    used.add(old)
+        for local in np.unique(columns['track']):
+            if int(local) not in mapping:
+                mapping[int(local)] = nextId
+                nextId += 1
+        own = select(columns, columns['frame'] < stop)
+        own['track'] = np.array([mapping[int(local)] for local in own['track']], np.int32)
+        parts.append(own)
+        previous = (columns, mapping)
+    if not parts:
+        return empty_tracks()
+    return {name: np.concatenate([part[name] for part in parts]) for name in TRACK_COLUMNS}
+
+
+# Count the frames from start on where a track of the earlier chunk and one of
+# the later chunk are the same kind of ball in the same place
+def overlap_votes(earlier, later, start, radii):
+    votes = Counter()
+    rows = np.nonzero(earlier['frame'] >= start)[0]
+    byFrame = {}
+    for i in rows:
+        byFrame.setdefault(int(earlier['frame'][i]), []).append(i)
+    for j in np.nonzero(later['frame'] < start + OVERLAP_FRAMES)[0]:
+        for i in byFrame.get(int(later['frame'][j]), ()):
+            if (earlier['label'][i] != later['label'][j]
+                    or earlier['stripe'][i] != later['stripe'][j]):
+                continue
+            distance = np.hypot(earlier['x'][i] - later['x'][j], earlier['y'][i] - later['y'][j])
+            if distance <= radii * earlier['r'][i]:
+                votes[(int(earlier['track'][i]), int(later['track'][j]))] += 1
+    return votes
+
+
+# Rows of the observations in frame, with the observations sorted by frame
+def frame_rows(tracks, frame):
+    return np.arange(np.searchsorted(tracks['frame'], frame, 'left'),
+                     np.searchsorted(tracks['frame'], frame, 'right'))
+
+
+# Find shots in the stitched observations of a video: runs of frames where
+# some ball moves, ended by REST_FRAMES still frames.
+# Returns (shots, balls) as columns. balls holds where every ball came to
+# rest after each shot, and shots the balls that went missing during it.
+def find_shots(tracks, frameCount, fps):
+    order = np.lexsort((tracks['frame'], tracks['track']))
+    frame, track = tracks['frame'][order], tracks['track'][order]
+    x, y = tracks['x'][order], tracks['y'][order]
+    label, stripe = tracks['label'][order], tracks['stripe'][order]
+    lag = MOVE_FRAMES
+    moving = np.zeros(len(order), bool)
+    if len(order) > lag:
+        same = (track[lag:] == track[:-lag]) & (frame[lag:] - frame[:-lag] <= 2 * lag)
+        moved = np.hypot(x[lag:] - x[:-lag], y[lag:] - y[:-lag]) > MOVE_DISTANCE
+        moving[lag:] = same & moved
+    active = np.zeros(max(frameCount, int(frame.max()) + 1 if len(frame) else 0), bool)
+    active[frame[moving]] = True
+
+    # Runs of moving frames, joining runs separated by fewer than REST_FRAMES still frames
+    runs = []
+    for f in np.nonzero(active)[0]:
+        if runs and f - runs[-1][1] <= REST_FRAMES:
+            runs[-1][1] = f
+        else:
+            runs.append([f, f])
+
+    byFrame = select(tracks, np.argsort(tracks['frame'], kind='stable'))
+    shots = {name: [] for name in ('shot', 'start_frame', 'end_frame', 'start_time', 'end_time',
+                                   'first_track', 'first_label', 'first_stripe', 'moved', 'missing')}
+    balls = {name: [] for name in ('shot',) + TRACK_COLUMNS[1:]}
+    for first, last in runs:
+        if last - first + 1 < MIN_SHOT_FRAMES:
+            continue
+        shot = len(shots['shot'])
+        during = moving & (frame >= first) & (frame <= last)
+        starter = np.nonzero(during)[0][np.argmin(frame[during])]
+        before = frame_rows(byFrame, max(first - 1, 0))
+        after = frame_rows(byFrame, min(last + 1, len(active) - 1))
+        shots['shot'].append(shot)
+        shots['start_frame'].append(first)
+        shots['end_frame'].append(last)
+        shots['start_time'].append(first / fps)
+        shots['end_time'].append(last / fps)
+        shots['first_track'].append(track[starter])
+        shots['first_label'].append(label[starter])
+        shots['first_stripe'].append(stripe[starter])
+        shots['moved'].append(len(np.unique(track[during])))
+        shots['missing'].append(len(set(byFrame['track'][before]) - set(byFrame['track'][after])))
+        for i in after:
+            balls['shot'].append(shot)
+            for name in TRACK_COLUMNS[1:]:
+                balls[name].append(byFrame[name][i])
+
+    shotTypes = dict(shot=np.int32, start_frame=np.int32, end_frame=np.int32,
+                     start_time=np.float32, end_time=np.float32, first_track=np.int32,
+                     first_label=np.int16, first_stripe=np.bool_, moved=np.int16, missing=np.int16)
+    ballTypes = dict(zip(TRACK_COLUMNS, TRACK_TYPES), shot=np.int32)
+    return ({name: np.array(values, shotTypes[name]) for name, values in shots.items()},
+            {name: np.array(values, ballTypes[name]) for name, values in balls.items()})
+
+
+# Analyze recorded videos with a pool of worker processes. Every video is cut
+# into chunks that are tracked in parallel, then stitched back together in
+# order. Returns the columns to save and (frames, seconds of video) analyzed.
+def analyze(videos, ballObjects, scale=DETECTION_SCALE, calibrationFile=None,
+            workers=None, chunkSeconds=CHUNK_SECONDS, keepTracks=False, progress=None):
+    names = [b.name for b in ballObjects]
+    white = cue_index(names)
+    jobs = []
+    plans = []
+    for v, video in enumerate(videos):
+        source = open_source(video, FAST, loop=False)
+        count, fps = int(source.get(cv2.CAP_PROP_FRAME_COUNT)), source.get(cv2.CAP_PROP_FPS)
+        source.release()
+        chunks = plan_chunks(count, chunkSeconds * fps)
+        plans.append((count, fps, len(chunks)))
+        calibration = None if is_rectified(video) else calibrationFile
+        jobs.extend((video, start, stop, OVERLAP_FRAMES, ballObjects, white, scale, calibration)
+                    for start, stop in chunks)
+
+    results = {'shot': [], 'ball': [], 'track': []}
+    totals = [0, 0.0]
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        done = pool.imap(analyze_chunk, jobs)
+        for v, (count, fps, chunkCount) in enumerate(plans):
+            chunks = []
+            for _ in range(chunkCount):
+                chunks.append(next(done))
+                if progress is not None:
+                    progress(videos[v], chunks[-1])
+            tracks = stitch(chunks)
+            shots, balls = find_shots(tracks, count, fps)
+            shots['video'] = np.full(len(shots['shot']), v, np.int16)
+            # Shot numbers run on across videos
+            offset = sum(len(part['shot']) for part in results['shot'])
+            shots['shot'] += offset
+            balls['shot'] += offset
+            results['shot'].append(shots)
+            results['ball'].append(balls)
+            if keepTracks:
+                tracks['video'] = np.full(len(tracks['frame']), v, np.int16)
+                results['track'].append(tracks)
+            totals[0] += count
+            totals[1] += count / fps if fps else 0.0
+
+    columns = {'videos': np.array([os.path.basename(video) for video in videos]),
+               'names': np.array(names)}
+    for kind, parts in results.items():
+        if not parts:
+            continue
+        for name in parts[0]:
+            columns['{}_{}'.format(kind, name)] = np.concatenate([part[name] for part in parts])
+    return columns, totals
+
+
+# Analyze a day of recordings and write the shots to a compressed .npz file
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the shots in recorded table videos using every core")
+    parser.add_argument('videos', nargs='+', help="video files or image directories")
+    parser.add_argument('--data', default=DATA_FILE, help="ball HSV settings file")
+    parser.add_argument('--calibration',
+                        help="table calibration file for raw camera videos; recordings made "
+                             "with app.py --record are already rectified and are not calibrated again")
+    parser.add_argument('--scale', type=float, default=DETECTION_SCALE,
+                        help="detection scale, 1 searches at full resolution")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument('--chunk', type=float, default=CHUNK_SECONDS,
+                        help="seconds of video per chunk")
+    parser.add_argument('--tracks', action='store_true',
+                        help="also write every ball's position in every frame")
+    parser.add_argument('-o', '--output', default='shots.npz', help="output .npz file")
+    args = parser.parse_args()
+
+    def progress(video, chunk):
+        start, stop, _, frames, seconds = chunk
+        print("{} frames {}-{}: {:.0f} fps".format(video, start, stop, frames / seconds if seconds else 0))
+
+    began = time.perf_counter()
+    columns, (frames, duration) = analyze(args.videos, load_balls(args.data), args.scale,
+                                          args.calibration, args.workers, args.chunk,
+                                          args.tracks, progress)
+    np.savez_compressed(args.output, **columns)
+    elapsed = time.perf_counter() - began
+    print("{} shots in {} frames ({:.0f} s of video) in {:.1f} s: {:.0f} fps, {:.1f}x real time".format(
+        len(columns.get('shot_shot', [])), frames, duration, elapsed, frames / elapsed,
+        duration / elapsed))
+    print("Wrote", args.output)
+
+
+if __name__ == "__main__":
+    main()
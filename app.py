@@ -1,9 +1,10 @@
 import tkinter as tk
+import argparse
+import multiprocessing
 import cv2
 import json
-import pymunk
 import math
-import random
+import time
 from enum import Enum
 from os import path
 from datetime import datetime
@@ -11,23 +12,105 @@ import numpy as np
 from PIL import Image
 from PIL import ImageTk
 from tkinter import ttk
+from detection import hsv_range_from_pixels, MIN_RADIUS, cue_index
+from sources import REPLAY_MODES, NATIVE
+from physics import resolve_shot, add_ball, remove_body
+from planner import ShotPlanner, ShotResult, BACKENDS, PYMUNK
+from batchphysics import simulate_shots, compare_trajectory
+from shotcache import ShotCache
+from snapshots import SnapshotStore
+from layouts import LayoutLibrary
+from compositor import Compositor
+from calibration import TableCalibration
+from timing import profiler
+from core import PoolCore, CAMERA_PORT, DATA_FILE
+from recorder import SessionRecorder
+from stream import MjpegStreamer, STREAM_HOST
+from scheduler import FrameScheduler, TARGET_FPS
+from preview import ShotPreview, draw_path
 
 # Constants
-MIN_RADIUS = 10
-MASS = 10
 SETUP_ERROR = 70
+# Opacity of the target positions shown while setting up the table
+SETUP_ALPHA = 0.25
 HEADER_FONT = ("Arial", 16)
 PARAGRAPH_FONT = ("Arial", 12)
-CAMERA_PORT = 0
-
-cap = cv2.VideoCapture(CAMERA_PORT,  cv2.CAP_DSHOW)
-space = pymunk.Space()
+# Milliseconds the settings sliders must be still before the preview updates
+SLIDER_DEBOUNCE = 100
+# Radius in pixels of the patch sampled when clicking a ball to calibrate it
+CLICK_RADIUS = 8
+# Frame scale for finding balls before refining at full resolution (1 = full resolution)
+DETECTION_SCALE = 1.0
+# Track locked balls in small windows instead of searching every frame
+TRACKING = True
+# Reuse the last detections while nothing moves near the balls
+MOTION_GATE = True
+# Balls the computer may shoot with, in order of preference
+COMPUTER_BALLS = ['White', 'Yellow']
+# Simulated shot outcomes are kept in this file across restarts (None keeps
+# them in memory only)
+SHOT_CACHE_FILE = 'shots.db'
+# Physics used by the shot search: pymunk, or the vectorized numpy solver
+PHYSICS_BACKEND = PYMUNK
+# Also resolve every computer shot with the numpy solver and print how far it
+# ends up from the pymunk world
+CROSS_CHECK = False
+# Suffix of the striped ball of a color
+STRIPE = ' stripe'
+# Draw the cue ball's predicted path while the player aims
+SHOT_PREVIEW = True
+
+# File the stage timings are written to on exit, if timing is enabled
+timingFile = None
+# Records game frames with their detections when started with --record
+recorder = None
+# Serves the annotated table view to spectators when started with --stream
+streamer = None
+# Runs the camera loop of the visible page
+scheduler = FrameScheduler(TARGET_FPS)
+planner = ShotPlanner(cache=ShotCache(filename=SHOT_CACHE_FILE), backend=PHYSICS_BACKEND)
+crossCheck = CROSS_CHECK
+shotPreview = SHOT_PREVIEW
 frameStack = []
 
-balls = ['Yellow', 'Blue', 'Red', 'Purple', 'Orange', 'Green']
+# Ball colors calibrated in the settings. Colors listed first win where HSV
+# ranges overlap, so White comes last.
+balls = ['Yellow', 'Blue', 'Red', 'Purple', 'Orange', 'Green', 'Maroon', 'Black', 'White']
 ballColors = [(0, 255, 255), (255, 0, 0), (0, 0, 255),
-              (128, 0, 128), (0, 128, 255), (0, 255, 0)]
+              (128, 0, 128), (0, 128, 255), (0, 255, 0),
+              (0, 0, 128), (60, 60, 60), (255, 255, 255)]
+# Colors that come as a solid and a striped ball
+STRIPES = balls[:7]
+# Every ball of a full rack by name
+ballNames = balls + [color + STRIPE for color in STRIPES]
+# Starting HSV ranges for colors missing from data.txt
+DEFAULT_RANGES = {
+    'Maroon': (0, 10, 120, 255, 30, 120),
+    'Black': (0, 179, 0, 255, 0, 50),
+    'White': (0, 179, 0, 40, 200, 255)
+}
+# HSV ranges, one Ball per color
 ballObjects = []
+# Frame source, detection and physics, opened in the background at startup
+core = PoolCore(ballObjects, DETECTION_SCALE, cue_index(balls), MIN_RADIUS, TRACKING,
+                MOTION_GATE)
+
+
+def ball_name(colorIndex, stripe=False):
+    return balls[colorIndex] + (STRIPE if stripe else '')
+
+
+# (colorIndex, stripe) of a ball name
+def ball_style(name):
+    stripe = name.endswith(STRIPE)
+    return balls.index(name[:-len(STRIPE)] if stripe else name), stripe
+
+
+# Outline a ball in its color, stripes with a white ring inside
+def draw_ball(image, center, radius, colorIndex, stripe=False, thickness=2):
+    cv2.circle(image, center, int(radius), ballColors[colorIndex], thickness)
+    if stripe:
+        cv2.circle(image, center, max(int(radius * 0.6), 1), (255, 255, 255), thickness)
 
 
 # Create trackbars for HSV colors
@@ -42,18 +125,20 @@ def create_trackbars():
 
 # Create data file with ball HSV values
 def create_data_file():
-    with open('data.txt', "w+") as file:
+    with open(DATA_FILE, "w+") as file:
         data = {}
         data['balls'] = []
         for ball in balls:
+            hMin, hMax, sMin, sMax, vMin, vMax = DEFAULT_RANGES.get(
+                ball, (0, 179, 0, 255, 0, 255))
             data['balls'].append({
                 ball: {
-                    'hMin': '0',
-                    'hMax': '179',
-                    'sMin': '0',
-                    'sMax': '255',
-                    'vMin': '0',
-                    'vMax': '255'
+                    'hMin': str(hMin),
+                    'hMax': str(hMax),
+                    'sMin': str(sMin),
+                    'sMax': str(sMax),
+                    'vMin': str(vMin),
+                    'vMax': str(vMax)
                 }
             })
         json.dump(data, file)
@@ -68,7 +153,7 @@ class PoolIRLApp(tk.Tk):
         tk.Tk.wm_title(self, "Pool IRL")
         tk.Tk.protocol(self, "WM_DELETE_WINDOW", self.delete_window)
 
-        if not path.exists('data.txt'):
+        if not path.exists(DATA_FILE):
             create_data_file()
 
         container = tk.Frame(self)
@@ -112,7 +197,22 @@ class PoolIRLApp(tk.Tk):
     # Destroy window
     def delete_window(self):
         try:
-            # cap.release()
+            core.release()
+            if recorder is not None:
+                recorder.close()
+            if streamer is not None:
+                streamer.stop()
+            scheduler.stop()
+            planner.shutdown()
+            if core.cap is not None:
+                print(core.cap.report())
+            if recorder is not None:
+                print(recorder.report())
+            if profiler.enabled:
+                print(scheduler.report())
+            if profiler.enabled and timingFile:
+                profiler.export(timingFile)
+            self.frames[PracticePage].snapshots.close()
             cv2.destroyAllWindows()
             tk.Tk.destroy(self)
         except:
@@ -172,11 +272,13 @@ class PracticePage(tk.Frame):
         img_scroller.pack(fill='y', side='right')
         self.cam = tk.Label(self)
         self.cam.pack()
-        self.job = None
-        self.overlay_imgs = []
-        self.overlay_times = []
+        self.compositor = Compositor(self.cam, streamer)
+        self.snapshots = SnapshotStore()
+        self.library = LayoutLibrary(ballNames)
         self.overlay_img = 0
         self.save_img = False
+        self.find_similar = False
+        self.match = None
         self.opacitySlider = tk.Scale(
             self, orient='horizontal', from_=0, to=1, resolution=0.05)
         self.opacitySlider.set(0.2)
@@ -184,46 +286,59 @@ class PracticePage(tk.Frame):
         saveButton = ttk.Button(
             self, text="Save", command=lambda: self.save())
         saveButton.pack()
+        similarButton = ttk.Button(
+            self, text="Find similar", command=lambda: self.similar())
+        similarButton.pack()
+        self.matchLabel = tk.Label(self, text="", fg="black", font=PARAGRAPH_FONT)
+        self.matchLabel.pack()
         backButton = ttk.Button(
             self, text="Back", command=lambda: (controller.show_frame(StartPage)))
         backButton.pack()
         self.bind("<<ShowFrame>>", self.onFocus)
 
     def show_camera(self):
-        ret, frame = cap.read()
-        cv2image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
+        ret, frame = core.capture().read()
+        (h, w) = frame.shape[:2]
         if (self.save_img):
-            self.overlay_imgs.insert(0, cv2image)
-            self.overlay_times.insert(0, datetime.now().strftime("%X"))
-            for i, img in enumerate(self.overlay_imgs):
-                (h, w, c) = img.shape
-                r = 150.0 / w
-                dim = (150, int(h*r))
-                image = cv2.resize(img, dim,
-                                   interpolation=cv2.INTER_AREA)
-                image = Image.fromarray(image)
-                photo = ImageTk.PhotoImage(image=image)
-                button = tk.Button(self.img_canvas, bd=1, fg="black",
-                                   command=lambda i=i, img=img: self.change_image(i))
-                button.image = photo
-                label = tk.Label(self.img_canvas, text=self.overlay_times[i])
-                button.configure(image=photo)
-                self.img_canvas.create_window(
-                    0, i*(h/4), anchor='nw', window=button, height=h/4, width=w/4)
-                self.img_canvas.create_window(
-                    0, i*(h/4), anchor='ne', window=label, height=h/4, width=w/4)
-                self.overlay_img = 0
-            self.img_canvas.configure(scrollregion=self.img_canvas.bbox(
-                'all'))
+            snapshot = self.snapshots.add(frame, datetime.now().strftime("%X"))
+            self.add_thumbnail(snapshot)
+            self.overlay_img = snapshot.id
+            self.library.add(self.detect_layout(frame), w, h,
+                             datetime.now().isoformat(timespec='seconds'))
             self.save_img = False
-        if (self.overlay_imgs):
-            cv2image = cv2.addWeighted(
-                cv2image, 1, self.overlay_imgs[self.overlay_img], self.opacitySlider.get(), 0)
-        img = Image.fromarray(cv2image)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.cam.imgtk = imgtk
-        self.cam.configure(image=imgtk)
-        self.job = self.cam.after(10, self.show_camera)
+        if (self.find_similar):
+            matches = self.library.nearest(self.detect_layout(frame), w, h, 1)
+            self.match = matches[0][1] if matches else None
+            self.matchLabel.configure(
+                text="Closest layout: {}".format(self.match['time']) if self.match else "No saved layouts")
+            self.find_similar = False
+        if self.match is not None:
+            # Draw the closest saved layout scaled to this frame
+            sx, sy = w / self.match['width'], h / self.match['height']
+            for name, (x, y, r) in self.match['balls'].items():
+                draw_ball(frame, (int(x*sx), int(y*sy)), r*sx, *ball_style(name))
+        ghost = None
+        if (self.snapshots):
+            ghost = self.snapshots.overlay(self.overlay_img)
+        self.compositor.present(frame, ghost=ghost, ghostAlpha=self.opacitySlider.get())
+
+    # Add the thumbnail of a new snapshot above the previous ones
+    def add_thumbnail(self, snapshot):
+        (h, w, c) = snapshot.shape
+        y = -snapshot.id*(h/4)
+        photo = ImageTk.PhotoImage(image=Image.fromarray(snapshot.thumbnail))
+        button = tk.Button(self.img_canvas, bd=1, fg="black",
+                           command=lambda i=snapshot.id: self.change_image(i))
+        button.image = photo
+        button.configure(image=photo)
+        label = tk.Label(self.img_canvas, text=snapshot.time)
+        self.img_canvas.create_window(
+            0, y, anchor='nw', window=button, height=h/4, width=w/4)
+        self.img_canvas.create_window(
+            0, y, anchor='ne', window=label, height=h/4, width=w/4)
+        self.img_canvas.configure(scrollregion=self.img_canvas.bbox(
+            'all'))
+        self.img_canvas.yview_moveto(0)
 
     def _on_mousewheel(self, event):
         self.img_canvas.yview_scroll(int(-1*(event.delta/120)), "units")
@@ -231,21 +346,39 @@ class PracticePage(tk.Frame):
     def change_image(self, i):
         self.overlay_img = i
 
+    # Detected (x, y, r) of every ball on the table, the largest if a ball
+    # appears twice
+    def detect_layout(self, frame):
+        layout = {}
+        for blob in core.detector.detectAll(frame, MIN_RADIUS):
+            name = ball_name(blob.label, blob.stripe)
+            if name not in layout or blob.r > layout[name][2]:
+                layout[name] = (blob.x, blob.y, blob.r)
+        return layout
+
     def save(self):
         self.save_img = True
 
+    def similar(self):
+        self.find_similar = True
+
     def onFocus(self, event):
         self.img_canvas.configure(scrollregion=(0, 0, 0, 0))
-        self.show_camera()
+        scheduler.start(self.cam, self.show_camera)
 
     def onFocusOut(self):
+        for child in self.img_canvas.winfo_children():
+            child.destroy()
         self.img_canvas.delete("all")
         self.overlay_img = 0
-        self.overlay_imgs = []
-        self.overlay_times = []
-        self.cam.after_cancel(self.job)
-
-# Ball class storing a name, physics values, and min/max hsv values
+        self.snapshots.clear()
+        self.match = None
+        self.matchLabel.configure(text="")
+        scheduler.stop(self.show_camera)
+
+# Ball class storing a name, physics values, and min/max hsv values.
+# ballObjects holds one per color for the HSV ranges, the game creates one per
+# ball on the table with its color index and pattern.
 class Ball:
     def __init__(self, name, hMin=0, hMax=179, sMin=0, sMax=255, vMin=0, vMax=255):
         self.name = name
@@ -258,56 +391,30 @@ class Ball:
         self.r = 0
         self.x = 0
         self.y = 0
-    
+        self.colorIndex = balls.index(name) if name in balls else 0
+        self.stripe = False
+        self.body = None
+        self.pocketed = False
+
     def init(self):
-        self.moment = pymunk.moment_for_circle(MASS, 0, self.r)
-        self.body = pymunk.Body(MASS, self.moment)
-        self.body.position = self.x, self.y
-        self.shape = pymunk.Circle(self.body, self.r)
-        self.shape.elasticity = 0.7
-        self.shape.friction = 0.8
-        self.shape.collision_type = 1
-        self.piv = pymunk.constraints.PivotJoint(space.static_body, self.body, (0,0), (0,0))
-        self.piv.max_force = 1000
-        self.piv.max_bias = 0
-        self.mot = pymunk.constraints.SimpleMotor(space.static_body, self.body, 0)
-        self.mot.max_force = 50000000
-        space.add(self.body, self.shape, self.piv, self.mot)
+        # Remove the body from the previous shot
+        if self.body is not None:
+            remove_body(core.getSpace(), self.body)
+        self.pocketed = False
+        self.body, self.shape, self.piv, self.mot = add_ball(core.getSpace(), self.x, self.y, self.r)
 
     def setPos(self, x, y, r):
         self.x = x
         self.y = y
         self.r = r
-        
+        self.pocketed = False
+
+
 class Turn(Enum):
     PLAYER = 1
     COMPUTER = 2
     SETUP = 3
 
-def collide(arbiter, space, data):
-    return True
-
-# Walls
-shape = pymunk.Segment(space.static_body, (1, 1), (1, cap.get(4)), 1.0)
-space.add(shape)
-shape.elasticity = 1
-shape.friction = 1
-
-shape = pymunk.Segment(space.static_body, (1, 1), (cap.get(3), 1), 1.0)
-space.add(shape)
-shape.elasticity = 1
-shape.friction = 1
-
-shape = pymunk.Segment(space.static_body, (cap.get(3), 1), (cap.get(3), cap.get(4)), 1.0)
-space.add(shape)
-shape.elasticity = 1
-shape.friction = 1
-
-shape = pymunk.Segment(space.static_body, (1, cap.get(4)), (cap.get(3), cap.get(4)), 1.0)
-space.add(shape)
-shape.elasticity = 1
-shape.friction = 1
-
 # Game page frame
 class GamePage(tk.Frame):
     def __init__(self, parent, controller):
@@ -318,7 +425,15 @@ class GamePage(tk.Frame):
         self.turn = Turn.PLAYER
         self.cam = tk.Label(self)
         self.cam.pack()
-        self.job = None
+        self.compositor = Compositor(self.cam, streamer)
+        self.frameIndex = -1
+        self.preview = ShotPreview(cue_index(balls))
+        self.trajectory = None
+        self.plan = None
+        self.shotBalls = []
+        self.onTable = []
+        self.tableBalls = {}
+        self.shotStart = 0
         self.turnButton = ttk.Button(
             self, text="End turn", command=lambda: (self.endTurn()))
         self.turnButton.pack()
@@ -328,134 +443,177 @@ class GamePage(tk.Frame):
         self.bind("<<ShowFrame>>", self.onFocus)
 
     def show_camera(self):
-        ret, frame = cap.read()
+        with profiler.stage('capture'):
+            frame, captureTime, index = core.capture().latest()
+        # Nothing new to detect while the player's turn shows the same frame
+        if self.turn == Turn.PLAYER and index == self.frameIndex:
+            return
+        self.frameIndex = index
+        # Keep the frame before anything is drawn on it
+        clean = frame.copy() if recorder is not None else None
+        tracks = None
+        simulated = None
 
         if self.turn == Turn.PLAYER:
-            for i, ball in enumerate(balls):
-                    # Covert BGR to HSV
-                    thresh = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-                    # Get HSV settings
-                    hMin, hMax, sMin, sMax, vMin, vMax = SettingsPage.getHSVSliders(
-                        ball)
-
-                    thresh = cv2.inRange(
-                        thresh, (hMin, sMin, vMin), (hMax, sMax, vMax))
-
-                    kernel = np.ones((5, 5), np.uint8)
-                    mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-                    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-
-                    # Get list of possible balls
-                    contours = cv2.findContours(
-                        mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-
-                    center = None
-
-                    if len(contours) > 0:
-                        # Get largest ball
-                        largestBall = max(contours, key=cv2.contourArea)
-                        (x, y), radius = cv2.minEnclosingCircle(largestBall)
-                        M = cv2.moments(largestBall)
-                        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-
-                        # Show ball outline
-                        if radius > MIN_RADIUS:
-                            ballObjects[balls.index(ball)].setPos(x, y, radius)
-                            cv2.circle(frame, center,
-                                    int(radius), ballColors[i], 2)
-        # Computer turn
+            self.onTable = []
+            with profiler.stage('detect'):
+                tracks = core.tracker.detect(frame)
+            # Find the cue before anything is drawn on the frame
+            path = None
+            if shotPreview:
+                with profiler.stage('preview'):
+                    path = self.preview.update(
+                        frame, [t for t in tracks if t.r > MIN_RADIUS], core.width, core.height)
+            for track in tracks:
+                # Show ball outline
+                if track.r > MIN_RADIUS:
+                    b = self.tableBall(track)
+                    b.setPos(track.x, track.y, track.r)
+                    self.onTable.append(b)
+                    draw_ball(frame, track.center, track.r, track.label, track.stripe)
+            if path is not None:
+                draw_path(frame, path)
+        # Computer turn: wait for the shot search, then play back the resolved shot
         elif self.turn == Turn.COMPUTER:
-            stop = True
-            for i, ball in enumerate(balls):
-                b = ballObjects[balls.index(ball)]
-                if b.r < cap.get(4)/2:
-                    cv2.circle(frame, (int(b.body.position[0]), int(b.body.position[1])), int(b.r), ballColors[i], 2)
-                    if b.body.velocity != (0,0):
-                        stop = False
-            if stop:
+            if self.trajectory is None and self.plan.done():
+                self.shoot(self.planResult())
+            if self.trajectory is None:
+                positions = [(b.x, b.y) for b in self.shotBalls]
+                onTable = [True] * len(self.shotBalls)
+            else:
+                positions = self.trajectory.positionsAt(time.monotonic() - self.shotStart)
+                onTable = self.trajectory.onTableAt(time.monotonic() - self.shotStart)
+            simulated = [[b.name, float(x), float(y)]
+                         for (x, y), visible, b in zip(positions, onTable, self.shotBalls) if visible]
+            for (x, y), visible, b in zip(positions, onTable, self.shotBalls):
+                if visible:
+                    draw_ball(frame, (int(x), int(y)), b.r, b.colorIndex, b.stripe)
+            if self.trajectory is not None and time.monotonic() - self.shotStart >= self.trajectory.duration:
                 self.turn = Turn.SETUP
         elif self.turn == Turn.SETUP:
-            shapes = np.zeros_like(frame, np.uint8)
+            shapes = self.compositor.layer(frame)
             aligned = True
-            for i, ball in enumerate(balls):
-                # Covert BGR to HSV
-                thresh = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-                # Get HSV settings
-                hMin, hMax, sMin, sMax, vMin, vMax = SettingsPage.getHSVSliders(
-                    ball)
-
-                thresh = cv2.inRange(
-                    thresh, (hMin, sMin, vMin), (hMax, sMax, vMax))
-
-                kernel = np.ones((5, 5), np.uint8)
-                mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-                mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-
-                # Get list of possible balls
-                contours = cv2.findContours(
-                    mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-
-                center = None
-
-                b = ballObjects[balls.index(ball)]
-
-                if len(contours) > 0:
-                    # Get largest ball
-                    largestBall = max(contours, key=cv2.contourArea)
-                    (x, y), radius = cv2.minEnclosingCircle(largestBall)
-                    M = cv2.moments(largestBall)
-                    center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-                    
-                    # Show ball outline
-                    if radius > MIN_RADIUS and b.r < cap.get(4)/2:
-                        cv2.line(frame, (int(x),int(y)), (int(b.body.position[0]),int(b.body.position[1])), (0,0,0), 8)
-                        print(b.name, math.sqrt(math.pow((x-b.body.position[0]),2) + math.pow((y-b.body.position[1]),2)))
-                        if (math.sqrt(math.pow((x-b.body.position[0]),2) + math.pow((y-b.body.position[1]),2))) > SETUP_ERROR:
-                            aligned = False
-                
-                if b.r < cap.get(4)/2:
-                    cv2.circle(shapes, (int(b.body.position[0]), int(b.body.position[1])), int(b.r), ballColors[i], cv2.FILLED)
-                    frame = cv2.addWeighted(frame, 1, shapes, 0.25, 0)
+            with profiler.stage('detect'):
+                tracks = [track for track in core.tracker.detect(frame) if track.r > MIN_RADIUS]
+            simulated = [[b.name, float(b.body.position[0]), float(b.body.position[1])]
+                         for b in self.shotBalls if not b.pocketed]
+            for b in self.shotBalls:
+                if b.pocketed:
+                    continue
+                bx, by = b.body.position
+
+                # Compare the target with the closest ball of the same color and pattern
+                track = min((t for t in tracks if t.label == b.colorIndex and t.stripe == b.stripe),
+                            key=lambda t: math.hypot(t.x - bx, t.y - by), default=None)
+                if track is not None:
+                    cv2.line(frame, (int(track.x), int(track.y)), (int(bx), int(by)), (0,0,0), 8)
+                    print(b.name, math.hypot(track.x - bx, track.y - by))
+                    if math.hypot(track.x - bx, track.y - by) > SETUP_ERROR:
+                        aligned = False
+
+                draw_ball(shapes, (int(bx), int(by)), b.r, b.colorIndex, b.stripe, cv2.FILLED)
 
             if aligned:
                 self.turn = Turn.PLAYER
                 self.turnButton['state'] = 'enabled'
 
-        cv2image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
-        img = Image.fromarray(cv2image)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.cam.imgtk = imgtk
-        self.cam.configure(image=imgtk)
-        space.step(0.01)
-
-        # Call show_camera after 10 ms
-        self.job = self.cam.after(10, self.show_camera)
-
+        if recorder is not None:
+            detections = None
+            if tracks is not None:
+                detections = [[t.id, ball_name(t.label, t.stripe), float(t.x), float(t.y), float(t.r)]
+                              for t in tracks]
+            recorder.record(clean, captureTime, detections, self.turn.name, simulated,
+                            core.calibration)
+
+        # Blend the translucent target balls once and paint the frame
+        profiler.drawOverlay(frame)
+        with profiler.stage('render'):
+            self.compositor.present(frame, SETUP_ALPHA)
+        profiler.frame(captureTime)
+
+    # The Ball of a tracked ball, created the first time it is seen
+    def tableBall(self, track):
+        if track.id not in self.tableBalls:
+            b = Ball(ball_name(track.label, track.stripe))
+            b.colorIndex = track.label
+            b.stripe = track.stripe
+            self.tableBalls[track.id] = b
+        return self.tableBalls[track.id]
+
+    # Search for the computer's shot on the shot planner's worker processes
     def computer(self):
-        b = ballObjects[balls.index("Yellow")]
-        b.body.apply_impulse_at_world_point((random.randint(5000,10000),random.randint(5000,10000)),(0,0))
-    
+        layout = [(b.x, b.y, b.r) for b in self.shotBalls]
+        names = [b.name for b in self.shotBalls]
+        cueIndices = []
+        for name in COMPUTER_BALLS:
+            if name in names:
+                cueIndices = [i for i, other in enumerate(names) if other == name]
+                break
+        self.plan = planner.submit(layout, core.width, core.height, cueIndices)
+
+    # The finished shot search, or no shot if it failed, so the turn still ends
+    def planResult(self):
+        try:
+            return self.plan.result()
+        except Exception as error:
+            print("Error: Shot search failed:", repr(error))
+            return ShotResult(None, None, None, 0, 0.0)
+
+    # Apply the planned shot, simulate it up front and play it back in show_camera
+    def shoot(self, result):
+        if result.impulse is not None:
+            b = self.shotBalls[result.cueIndex]
+            b.body.apply_impulse_at_world_point(result.impulse, b.body.position)
+            print("Shot search: {} candidates ({} cached) in {:.2f}s ({:.0f}/s), score {:.1f}".format(
+                result.evaluated, result.cached, result.seconds, result.candidatesPerSecond,
+                result.score))
+        with profiler.stage('physics'):
+            self.trajectory = resolve_shot(
+                core.getSpace(), [b.body for b in self.shotBalls])
+        if crossCheck and result.impulse is not None:
+            self.crossCheck(result)
+        # Pocketed balls disappear from the playback when they go down
+        for b, pocket in zip(self.shotBalls, self.trajectory.pocketed):
+            if pocket is not None:
+                b.pocketed = True
+        self.shotStart = time.monotonic()
+
+    # Compare the shot resolved in the pymunk world with the numpy solver
+    def crossCheck(self, result):
+        layout = [(b.x, b.y, b.r) for b in self.shotBalls]
+        final, pocketed, _ = simulate_shots(layout, core.width, core.height,
+                                            [result.cueIndex], [result.impulse])
+        error, agree = compare_trajectory(self.trajectory, final[0], pocketed[0])
+        print("Cross-check: numpy solver {:.1f} px from pymunk, pocketed balls {}".format(
+            error, "agree" if agree else "differ"))
+
     def endTurn(self):
         self.turn = Turn.COMPUTER
         self.turnButton['state'] = 'disabled'
-        for i, ball in enumerate(balls):
-                b = ballObjects[balls.index(ball)]
-                if b.r < cap.get(4)/2:
-                    b.init()
-        handler = space.add_collision_handler(1, 1)
-        handler = space.add_collision_handler(1, 2)
-        handler.begin = collide
+        self.trajectory = None
+        # Balls from the previous shot that have left the table
+        for b in self.shotBalls:
+            if b.body is not None and b not in self.onTable:
+                remove_body(core.getSpace(), b.body)
+                b.body = None
+        self.shotBalls = []
+        for b in self.onTable:
+            if b.r < core.height/2 and not b.pocketed:
+                b.init()
+                self.shotBalls.append(b)
+        self.tableBalls = {id: b for id, b in self.tableBalls.items() if b in self.onTable}
         self.computer()
 
     def onFocus(self, event):
         # Start showing camera when GamePage is focused
-        self.show_camera()
+        core.tracker.reset()
+        self.preview.reset()
+        self.frameIndex = -1
+        scheduler.start(self.cam, self.show_camera)
 
     def onFocusOut(self):
         # Terminate showing camera
-        self.cam.after_cancel(self.job)
+        scheduler.stop(self.show_camera)
 
 
 # Settings page frame
@@ -466,8 +624,13 @@ class SettingsPage(tk.Frame):
                                      fg="black", font=HEADER_FONT)
         self.headingLabel.pack(pady=10, padx=10)
         self.initBalls()
-        self.job = None
+        self.slideJob = None
         self.data = None
+        self.colorIndex = 0
+        self.frameIndex = -1
+        self.values = None
+        self.hsv = None
+        self.corners = None
         self.variable = tk.StringVar(self)
         self.variable.set(balls[0])
         colorMenu = tk.OptionMenu(
@@ -478,47 +641,60 @@ class SettingsPage(tk.Frame):
             self, text="hMin", fg="black", font=PARAGRAPH_FONT)
         hMinLabel.pack()
         self.hMinSlider = tk.Scale(
-            self, orient='horizontal', from_=0, to=179)
+            self, orient='horizontal', from_=0, to=179, command=self.onSlide)
         self.hMinSlider.pack()
 
         hMaxLabel = tk.Label(
             self, text="hMax", fg="black", font=PARAGRAPH_FONT)
         hMaxLabel.pack()
         self.hMaxSlider = tk.Scale(
-            self, orient='horizontal', from_=0, to=179)
+            self, orient='horizontal', from_=0, to=179, command=self.onSlide)
         self.hMaxSlider.pack()
 
         sMinLabel = tk.Label(
             self, text="sMin", fg="black", font=PARAGRAPH_FONT)
         sMinLabel.pack()
         self.sMinSlider = tk.Scale(
-            self, orient='horizontal', from_=0, to=255)
+            self, orient='horizontal', from_=0, to=255, command=self.onSlide)
         self.sMinSlider.pack()
 
         sMaxLabel = tk.Label(
             self, text="sMax", fg="black", font=PARAGRAPH_FONT)
         sMaxLabel.pack()
         self.sMaxSlider = tk.Scale(
-            self, orient='horizontal', from_=0, to=255)
+            self, orient='horizontal', from_=0, to=255, command=self.onSlide)
         self.sMaxSlider.pack()
 
         vMinLabel = tk.Label(
             self, text="vMin", fg="black", font=PARAGRAPH_FONT)
         vMinLabel.pack()
         self.vMinSlider = tk.Scale(
-            self, orient='horizontal', from_=0, to=255)
+            self, orient='horizontal', from_=0, to=255, command=self.onSlide)
         self.vMinSlider.pack()
 
         vMaxLabel = tk.Label(
             self, text="vMax", fg="black", font=PARAGRAPH_FONT)
         vMaxLabel.pack()
         self.vMaxSlider = tk.Scale(
-            self, orient='horizontal', from_=0, to=255)
+            self, orient='horizontal', from_=0, to=255, command=self.onSlide)
         self.vMaxSlider.pack()
 
         saveButton = ttk.Button(
             self, text="Save", command=lambda: self.save())
         saveButton.pack()
+        clickLabel = tk.Label(
+            self, text="Click a ball in the Camera window to calibrate it",
+            fg="black", font=PARAGRAPH_FONT)
+        clickLabel.pack()
+        calibrateButton = ttk.Button(
+            self, text="Calibrate table", command=lambda: self.calibrate())
+        calibrateButton.pack()
+        resetButton = ttk.Button(
+            self, text="Reset calibration", command=lambda: self.resetCalibration())
+        resetButton.pack()
+        self.calibrationLabel = tk.Label(
+            self, text="", fg="black", font=PARAGRAPH_FONT)
+        self.calibrationLabel.pack()
         backButton = ttk.Button(
             self, text="Back", command=lambda: (controller.show_frame(frameStack[1])))
         backButton.pack()
@@ -526,7 +702,7 @@ class SettingsPage(tk.Frame):
 
     def initBalls(self):
         for ball in balls:
-            b = Ball(ball)
+            b = Ball(ball, *DEFAULT_RANGES.get(ball, ()))
             ballObjects.append(b)
         self.loadBalls()
 
@@ -542,35 +718,69 @@ class SettingsPage(tk.Frame):
         return values
 
     def save(self):
-        colorIndex = balls.index(self.variable.get())
-        ballObjects[colorIndex].hMin = self.hMinSlider.get()
-        ballObjects[colorIndex].hMax = self.hMaxSlider.get()
-        ballObjects[colorIndex].sMin = self.sMinSlider.get()
-        ballObjects[colorIndex].sMax = self.sMaxSlider.get()
-        ballObjects[colorIndex].vMin = self.vMinSlider.get()
-        ballObjects[colorIndex].vMax = self.vMaxSlider.get()
+        self.applySliders()
         self.saveToFile()
 
+    # Apply slider values to the selected ball once the sliders have been still
+    # for SLIDER_DEBOUNCE ms
+    def onSlide(self, value=None):
+        if self.slideJob is not None:
+            self.after_cancel(self.slideJob)
+        self.slideJob = self.after(SLIDER_DEBOUNCE, self.applySliders)
+
+    def applySliders(self):
+        if self.slideJob is not None:
+            self.after_cancel(self.slideJob)
+            self.slideJob = None
+        ballObjects[self.colorIndex].hMin = self.hMinSlider.get()
+        ballObjects[self.colorIndex].hMax = self.hMaxSlider.get()
+        ballObjects[self.colorIndex].sMin = self.sMinSlider.get()
+        ballObjects[self.colorIndex].sMax = self.sMaxSlider.get()
+        ballObjects[self.colorIndex].vMin = self.vMinSlider.get()
+        ballObjects[self.colorIndex].vMax = self.vMaxSlider.get()
+
+    # Fill the sliders with the HSV range of the pixels around a clicked ball
+    def onClick(self, event, x, y, flags, param):
+        if event != cv2.EVENT_LBUTTONDOWN or self.hsv is None:
+            return
+        patch = self.hsv[max(y - CLICK_RADIUS, 0):y + CLICK_RADIUS + 1,
+                         max(x - CLICK_RADIUS, 0):x + CLICK_RADIUS + 1]
+        if patch.size == 0:
+            return
+        hMin, hMax, sMin, sMax, vMin, vMax = hsv_range_from_pixels(patch)
+        self.hMinSlider.set(hMin)
+        self.hMaxSlider.set(hMax)
+        self.sMinSlider.set(sMin)
+        self.sMaxSlider.set(sMax)
+        self.vMinSlider.set(vMin)
+        self.vMaxSlider.set(vMax)
+        self.applySliders()
+
     def loadBalls(self):
-        with open('data.txt') as file:
+        with open(DATA_FILE) as file:
             self.data = json.load(file)
+            # Colors added since the file was saved keep their defaults
+            saved = {}
+            for entry in self.data['balls']:
+                saved.update(entry)
 
             for ballObject in ballObjects:
-                ballObject.hMin = int(self.data['balls'][balls.index(
-                    ballObject.name)].get(ballObject.name).get('hMin'))
-                ballObject.hMax = int(self.data['balls'][balls.index(
-                    ballObject.name)].get(ballObject.name).get('hMax'))
-                ballObject.sMin = int(self.data['balls'][balls.index(
-                    ballObject.name)].get(ballObject.name).get('sMin'))
-                ballObject.sMax = int(self.data['balls'][balls.index(
-                    ballObject.name)].get(ballObject.name).get('sMax'))
-                ballObject.vMin = int(self.data['balls'][balls.index(
-                    ballObject.name)].get(ballObject.name).get('vMin'))
-                ballObject.vMax = int(self.data['balls'][balls.index(
-                    ballObject.name)].get(ballObject.name).get('vMax'))
+                if ballObject.name not in saved:
+                    continue
+                values = saved[ballObject.name]
+                ballObject.hMin = int(values.get('hMin'))
+                ballObject.hMax = int(values.get('hMax'))
+                ballObject.sMin = int(values.get('sMin'))
+                ballObject.sMax = int(values.get('sMax'))
+                ballObject.vMin = int(values.get('vMin'))
+                ballObject.vMax = int(values.get('vMax'))
 
     def onChange(self, event=None):
-        colorIndex = balls.index(self.variable.get())
+        # Apply pending slider moves to the previously selected ball first
+        if self.slideJob is not None:
+            self.applySliders()
+        self.colorIndex = balls.index(self.variable.get())
+        colorIndex = self.colorIndex
         self.hMinSlider.set(ballObjects[colorIndex].hMin)
         self.hMaxSlider.set(ballObjects[colorIndex].hMax)
         self.sMinSlider.set(ballObjects[colorIndex].sMin)
@@ -579,30 +789,41 @@ class SettingsPage(tk.Frame):
         self.vMaxSlider.set(ballObjects[colorIndex].vMax)
 
     def update(self):
-        colorIndex = balls.index(self.variable.get())
-        ret, frame = cap.read()
-
-        thresh = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-        hMin, hMax, sMin, sMax, vMin, vMax = SettingsPage.getHSVSliders(
-            balls[colorIndex])
-
-        thresh = cv2.inRange(
-            thresh, (hMin, sMin, vMin), (hMax, sMax, vMax))
-
-        kernel = np.ones((5, 5), np.uint8)
-        mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-
-        # Show Thresh and Mask frames
-        cv2.imshow("Thresh", thresh)
-        cv2.imshow("Mask", mask)
-
-        self.job = self.headingLabel.after(10, self.update)
+        frame, timestamp, index = core.capture().latest()
+        values = tuple(SettingsPage.getHSVSliders(balls[self.colorIndex]))
+
+        # Only recompute the preview when there is a new frame or new values
+        if frame is not None and (index != self.frameIndex or values != self.values):
+            self.frameIndex = index
+            self.values = values
+            self.hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+
+            hMin, hMax, sMin, sMax, vMin, vMax = values
+
+            thresh = cv2.inRange(
+                self.hsv, (hMin, sMin, vMin), (hMax, sMax, vMax))
+
+            kernel = np.ones((5, 5), np.uint8)
+            mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+
+            # Show Camera, Thresh and Mask frames
+            cv2.imshow("Camera", frame)
+            cv2.imshow("Thresh", thresh)
+            cv2.imshow("Mask", mask)
+
+        # Show the raw camera frame with the corners marked so far
+        if self.corners is not None:
+            raw, _, _ = core.capture().latest(raw=True)
+            if raw is not None:
+                for corner in self.corners:
+                    cv2.circle(raw, corner, 6, (0, 0, 255), 2)
+                cv2.imshow("Calibration", raw)
+        cv2.waitKey(1)
 
     # Save ball HSV values to data file
     def saveToFile(self):
-        with open('data.txt', "w+") as file:
+        with open(DATA_FILE, "w+") as file:
             data = {}
             data['balls'] = []
             for i, ball in enumerate(balls):
@@ -618,16 +839,100 @@ class SettingsPage(tk.Frame):
                 })
             json.dump(data, file)
 
+    # Start marking the table corners in the Calibration window
+    def calibrate(self):
+        self.corners = []
+        self.calibrationLabel.configure(
+            text="Click the table corners: top left, top right, bottom right, bottom left")
+        cv2.namedWindow("Calibration")
+        cv2.setMouseCallback("Calibration", self.onCorner)
+
+    def onCorner(self, event, x, y, flags, param):
+        if event != cv2.EVENT_LBUTTONDOWN or self.corners is None:
+            return
+        self.corners.append((x, y))
+        if len(self.corners) == 4:
+            calibration = TableCalibration(self.corners)
+            calibration.save()
+            core.applyCalibration(calibration)
+            self.corners = None
+            self.frameIndex = -1
+            self.calibrationLabel.configure(text="Table calibrated: {} x {}".format(
+                calibration.width, calibration.height))
+            cv2.destroyWindow("Calibration")
+
+    def resetCalibration(self):
+        TableCalibration.remove()
+        core.applyCalibration(None)
+        self.frameIndex = -1
+        self.calibrationLabel.configure(text="Table calibration removed")
+
     def onFocus(self, event):
         self.onChange()
-        self.update()
+        self.frameIndex = -1
+        cv2.namedWindow("Camera")
+        cv2.setMouseCallback("Camera", self.onClick)
+        scheduler.start(self.headingLabel, self.update)
 
     def onFocusOut(self):
-        self.headingLabel.after_cancel(self.job)
+        scheduler.stop(self.update)
+        self.corners = None
+        self.calibrationLabel.configure(text="")
+        if self.slideJob is not None:
+            self.applySliders()
         self.saveToFile()
         cv2.destroyAllWindows()
 
 
 # Start app
-app = PoolIRLApp()
-app.mainloop()
+if __name__ == "__main__":
+    # Shot search worker processes must not start the GUI
+    multiprocessing.freeze_support()
+
+    # Frame source: a camera port, a video file or a directory of images
+    parser = argparse.ArgumentParser(description="Pool IRL")
+    parser.add_argument('source', nargs='?', default=CAMERA_PORT,
+                        help="camera port, video file or image directory")
+    parser.add_argument('--replay', choices=REPLAY_MODES, default=NATIVE,
+                        help="playback speed for recorded sources")
+    parser.add_argument('--timing', metavar='FILE',
+                        help="time each stage of the game loop and write a .csv or .json summary on exit")
+    parser.add_argument('--fps-overlay', action='store_true',
+                        help="show FPS and latency on the game video")
+    parser.add_argument('--physics', choices=BACKENDS, default=PHYSICS_BACKEND,
+                        help="physics backend for the computer's shot search")
+    parser.add_argument('--cross-check', action='store_true', default=CROSS_CHECK,
+                        help="compare every computer shot with the numpy solver")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record the game video to FILE (.avi) with a .jsonl file of detections")
+    parser.add_argument('--no-preview', dest='preview', action='store_false', default=SHOT_PREVIEW,
+                        help="do not draw the cue ball's predicted path while aiming")
+    parser.add_argument('--scale', type=float, default=DETECTION_SCALE,
+                        help="detection scale, 1 searches at full resolution")
+    parser.add_argument('--fps', type=float, default=TARGET_FPS,
+                        help="frame rate the camera views aim for")
+    parser.add_argument('--stream', metavar='PORT', type=int,
+                        help="serve the annotated table view as MJPEG on http://HOST:PORT/")
+    parser.add_argument('--stream-host', default=STREAM_HOST,
+                        help="address the spectator stream listens on")
+    args = parser.parse_args()
+
+    timingFile = args.timing
+    crossCheck = args.cross_check
+    shotPreview = args.preview
+    scheduler.setFps(args.fps)
+    core.detector.scale = args.scale
+    if args.physics != planner.backend:
+        planner = ShotPlanner(cache=planner.cache, backend=args.physics)
+    if args.timing or args.fps_overlay:
+        profiler.enable(overlay=args.fps_overlay)
+
+    # Open the camera and apply the table calibration while the window starts
+    core.open(args.source, args.replay)
+    if args.record:
+        recorder = SessionRecorder(args.record, scheduler.fps).start()
+    if args.stream is not None:
+        streamer = MjpegStreamer(args.stream_host, args.stream).start()
+
+    app = PoolIRLApp()
+    app.mainloop()
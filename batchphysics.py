@@ -0,0 +1,167 @@
+import numpy as np
+from physics import (MASS, TIME_STEP, REST_SPEED, MAX_SHOT_TIME, pockets, pocket_radius,
+                     build_world, resolve_shot)
+
+# Deceleration from the rolling friction pivot joint: its max force over the mass
+ROLLING_DECELERATION = 1000 / MASS
+# Restitution of ball-ball and ball-cushion contacts (pymunk multiplies elasticities)
+BALL_ELASTICITY = 0.7 * 0.7
+WALL_ELASTICITY = 0.7 * 1.0
+# Contact friction, again the product of the two shapes' friction
+BALL_FRICTION = 0.8 * 0.8
+WALL_FRICTION = 0.8 * 1.0
+# Cushion segments lie on the table edge with this radius, as in add_walls
+WALL_RADIUS = 1.0
+
+
+# Simulates many independent shots on the same layout at once with NumPy.
+# Every array has a batch dimension of candidate shots, so collisions between
+# balls, cushions and pockets are found for all tables in one step. Each
+# step only tests moving balls against the others, and only balls near the
+# rails against the cushions and pockets. Balls slide without spin, as in the
+# pymunk world where a motor keeps them from rotating, so contact friction
+# acts on their velocity alone.
+# Returns (final, pocketed, steps): final ball positions (shots, balls, 2),
+# the step each ball was pocketed on or -1, and the steps each shot took.
+def simulate_shots(layout, width, height, cueIndices, impulses, dt=TIME_STEP,
+                   maxTime=MAX_SHOT_TIME, restSpeed=REST_SPEED):
+    layout = np.asarray(layout, np.float64).reshape(-1, 3)
+    shots = len(cueIndices)
+    count = len(layout)
+    position = np.repeat(layout[np.newaxis, :, :2], shots, axis=0)
+    velocity = np.zeros_like(position)
+    velocity[np.arange(shots), cueIndices] = np.asarray(impulses, np.float64).reshape(-1, 2) / MASS
+    radius = layout[:, 2]
+    onTable = np.ones((shots, count), bool)
+    pocketed = np.full((shots, count), -1, np.int32)
+    steps = np.zeros(shots, np.int32)
+
+    pocketPositions = np.array(pockets(width, height), np.float64)
+    reach = pocket_radius(width, height) + radius
+    gap = pocket_radius(width, height)
+    low = 1 + WALL_RADIUS + radius
+    high = np.array([width, height]) - WALL_RADIUS - radius[:, np.newaxis]
+    touching = (radius[:, np.newaxis] + radius[np.newaxis, :])
+    touchingSquared = touching ** 2
+    reachSquared = reach ** 2
+    columns = np.arange(count)
+    slowdown = ROLLING_DECELERATION * dt
+
+    active = np.arange(shots)
+    for step in range(1, int(maxTime / dt) + 1):
+        if len(active) == 0:
+            break
+        p = position[active]
+        v = velocity[active]
+        on = onTable[active]
+
+        # Rolling friction takes a fixed amount of speed off every step
+        speed = np.hypot(v[:, :, 0], v[:, :, 1])
+        scale = np.where(speed > slowdown, 1 - slowdown / np.maximum(speed, 1e-12), 0.0)
+        v *= scale[:, :, np.newaxis]
+
+        # Ball-ball contacts between balls on the table. Only a moving ball can
+        # run into another, so only moving balls are tested against the rest,
+        # except on the first step where overlaps in the layout are pushed apart.
+        moving = on if step == 1 else on & (scale > 0)
+        b, i = np.nonzero(moving)
+        x, y = p[:, :, 0], p[:, :, 1]
+        # Offsets from each moving ball to every ball of its table
+        dx = x[b] - x[b, i][:, np.newaxis]
+        dy = y[b] - y[b, i][:, np.newaxis]
+        # Two moving balls find each other: keep the pair once, and no ball
+        # touches itself
+        contact = ((dx * dx + dy * dy < touchingSquared[i]) & on[b]
+                   & ~(moving[b] & (columns <= i[:, np.newaxis])))
+        if contact.any():
+            k, j = np.nonzero(contact)
+            b, i = b[k], i[k]
+            delta = np.stack([dx[k, j], dy[k, j]], axis=1)
+            distance = np.sqrt((delta ** 2).sum(axis=1))
+            normal = delta / np.maximum(distance, 1e-9)[:, np.newaxis]
+            closing = ((v[b, i] - v[b, j]) * normal).sum(axis=1)
+            approaching = closing > 0
+            push = (1 + BALL_ELASTICITY) / 2 * np.where(approaching, closing, 0)
+            # Friction stops the sliding along the contact, up to its limit
+            relative = v[b, i] - v[b, j]
+            sliding = relative - closing[:, np.newaxis] * normal
+            slide = np.sqrt((sliding ** 2).sum(axis=1))
+            rub = np.minimum(BALL_FRICTION * push, slide / 2) / np.maximum(slide, 1e-9)
+            impulse = push[:, np.newaxis] * normal + rub[:, np.newaxis] * sliding
+            # Push overlapping balls apart so they do not sink into each other
+            overlap = (touching[i, j] - distance)[:, np.newaxis] / 2 * normal
+            np.add.at(v, (b, i), -impulse)
+            np.add.at(v, (b, j), impulse)
+            np.add.at(p, (b, i), -overlap)
+            np.add.at(p, (b, j), overlap)
+
+        # Cushions, except in the gaps left at the pockets. Only balls past a
+        # cushion line can touch one.
+        x, y = p[:, :, 0], p[:, :, 1]
+        b, i = np.nonzero(on & ((x < low) | (x > high[:, 0]) | (y < low) | (y > high[:, 1])))
+        if len(b):
+            q, u = p[b, i], v[b, i]
+            x, y = q[:, 0], q[:, 1]
+            inX = (x > 1 + gap) & ((x < width / 2 - gap) | (x > width / 2 + gap)) & (x < width - gap)
+            inY = (y > 1 + gap) & (y < height - gap)
+            for axis, along in ((0, inY), (1, inX)):
+                hitLow = along & (q[:, axis] < low[i]) & (u[:, axis] < 0)
+                hitHigh = along & (q[:, axis] > high[i, axis]) & (u[:, axis] > 0)
+                hit = hitLow | hitHigh
+                into = np.abs(u[:, axis])
+                other = u[:, 1 - axis]
+                rub = np.minimum(WALL_FRICTION * (1 + WALL_ELASTICITY) * into, np.abs(other))
+                u[:, 1 - axis] = np.where(hit, other - np.sign(other) * rub, other)
+                u[:, axis] = np.where(hit, -WALL_ELASTICITY * u[:, axis], u[:, axis])
+                q[:, axis] = np.where(along, np.clip(q[:, axis], low[i], high[i, axis]), q[:, axis])
+            p[b, i] = q
+            v[b, i] = u
+
+        v[~on] = 0
+        p += v * dt
+
+        # Balls touching a pocket sensor leave the table. Every pocket is on
+        # the top or bottom rail, so only balls near those can reach one.
+        b, i = np.nonzero(on & ((p[:, :, 1] < reach) | (p[:, :, 1] > height - reach)))
+        if len(b):
+            offsets = p[b, i][:, np.newaxis, :] - pocketPositions
+            sunk = (offsets ** 2).sum(axis=2).min(axis=1) < reachSquared[i]
+            b, i = b[sunk], i[sunk]
+            pocketed[active[b], i] = step - 1
+            on[b, i] = False
+            v[b, i] = 0
+
+        position[active] = p
+        velocity[active] = v
+        onTable[active] = on
+        steps[active] = step
+
+        moving = ((np.hypot(v[:, :, 0], v[:, :, 1]) >= restSpeed) & on).any(axis=1)
+        active = active[moving]
+    return position, pocketed, steps
+
+
+# Resolve the same shots in pymunk and with the vectorized solver.
+# Returns a list of (largest position difference in pixels, pocketed balls
+# agree) per shot.
+def cross_check(layout, width, height, shots):
+    final, pocketed, _ = simulate_shots(layout, width, height,
+                                        [cueIndex for cueIndex, _ in shots],
+                                        [impulse for _, impulse in shots])
+    results = []
+    for k, (cueIndex, impulse) in enumerate(shots):
+        space, bodies = build_world(layout, width, height)
+        body = bodies[cueIndex]
+        body.apply_impulse_at_world_point(impulse, body.position)
+        results.append(compare_trajectory(resolve_shot(space, bodies), final[k], pocketed[k]))
+    return results
+
+
+# Compare a pymunk trajectory with one vectorized result
+def compare_trajectory(trajectory, final, pocketed):
+    expected = trajectory.finalPositions()
+    onTable = [pocket is None for pocket in trajectory.pocketed]
+    agree = all((p < 0) == on for p, on in zip(pocketed, onTable))
+    both = [i for i, on in enumerate(onTable) if on and pocketed[i] < 0]
+    error = max((float(np.hypot(*(final[i] - expected[i]))) for i in both), default=0.0)
+    return error, agree
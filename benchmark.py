@@ -0,0 +1,101 @@
+import argparse
+import math
+import time
+import cv2
+from core import load_balls, DATA_FILE
+from detection import BallDetector, BallTracker, MotionGate, MIN_RADIUS, cue_index
+from sources import open_source, FAST, REPLAY_MODES, DEFAULT_FPS
+
+
+# Tracker set up like the game's, for one detection scale
+def game_tracker(ballObjects, scale, gate=True):
+    white = cue_index([b.name for b in ballObjects])
+    return BallTracker(BallDetector(ballObjects, scale, white), MIN_RADIUS,
+                       gate=MotionGate() if gate else None)
+
+
+# Run the game's ball tracking over a source. Returns the balls of every frame
+# as (label, stripe, x, y, r) tuples and the seconds taken.
+def run(source, tracker, maxFrames):
+    fps = source.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+    detections = []
+    elapsed = 0.0
+    while not maxFrames or len(detections) < maxFrames:
+        ret, frame = source.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        # Video time keeps the motion gate independent of the benchmark's speed
+        tracks = tracker.detect(frame, len(detections) / fps)
+        elapsed += time.perf_counter() - start
+        detections.append([(t.label, t.stripe, t.x, t.y, t.r) for t in tracks if t.r > MIN_RADIUS])
+    source.release()
+    return detections, elapsed
+
+
+# Compare detections against a reference run. Every reference ball is matched
+# to the closest unmatched ball of the same color and pattern within its radius.
+# Returns (mean center error, max center error, mean radius error, missed, extra).
+def compare(reference, detections):
+    centerErrors = []
+    radiusErrors = []
+    missed = 0
+    extra = 0
+    for expected, actual in zip(reference, detections):
+        unused = list(actual)
+        for label, stripe, x, y, r in expected:
+            candidates = [(math.hypot(x - a[2], y - a[3]), k) for k, a in enumerate(unused)
+                          if a[0] == label and a[1] == stripe]
+            distance, k = min(candidates, default=(None, None))
+            if k is None or distance > r:
+                missed += 1
+                continue
+            centerErrors.append(distance)
+            radiusErrors.append(abs(r - unused.pop(k)[4]))
+        extra += len(unused)
+    if not centerErrors:
+        return 0.0, 0.0, 0.0, missed, extra
+    return (sum(centerErrors) / len(centerErrors), max(centerErrors),
+            sum(radiusErrors) / len(radiusErrors), missed, extra)
+
+
+# Run the GamePage ball tracking over a recorded session at one or more
+# detection scales and report throughput and accuracy against full resolution
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ball detection on a video file or image directory")
+    parser.add_argument('source', help="video file or directory of images")
+    parser.add_argument('--data', default=DATA_FILE, help="ball HSV settings file")
+    parser.add_argument('--frames', type=int, default=0,
+                        help="stop after this many frames (default: whole source)")
+    parser.add_argument('--replay', choices=REPLAY_MODES, default=FAST)
+    parser.add_argument('--scales', default='1',
+                        help="comma separated detection scales, e.g. 1,0.5,0.25")
+    parser.add_argument('--no-gate', dest='gate', action='store_false',
+                        help="detect on every frame instead of only when balls move")
+    args = parser.parse_args()
+
+    ballObjects = load_balls(args.data)
+    scales = [float(scale) for scale in args.scales.split(',')]
+    reference = None
+    if scales[0] != 1:
+        reference, _ = run(open_source(args.source, args.replay, loop=False),
+                           game_tracker(ballObjects, 1, args.gate), args.frames)
+
+    print("{:>6} {:>7} {:>8} {:>8} {:>10} {:>10} {:>10} {:>7} {:>7}".format(
+        "scale", "frames", "fps", "ms", "detections", "center px", "max px", "missed", "extra"))
+    for scale in scales:
+        detections, elapsed = run(open_source(args.source, args.replay, loop=False),
+                                  game_tracker(ballObjects, scale, args.gate), args.frames)
+        if reference is None:
+            reference = detections
+        centerError, maxError, radiusError, missed, extra = compare(reference, detections)
+        frames = len(detections)
+        found = sum(len(d) for d in detections)
+        print("{:>6g} {:>7} {:>8.1f} {:>8.2f} {:>10} {:>10.2f} {:>10.2f} {:>7} {:>7}".format(
+            scale, frames, frames / elapsed if elapsed else 0.0,
+            1000 * elapsed / frames if frames else 0.0, found, centerError, maxError,
+            missed, extra))
+
+if __name__ == "__main__":
+    main()
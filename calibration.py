@@ -0,0 +1,107 @@
+import json
+import os
+import cv2
+import numpy as np
+
+CALIBRATION_FILE = 'calibration.json'
+# Length to width ratio of the playing surface
+TABLE_ASPECT = 2.0
+
+
+# Output size of the rectified table from its corners, keeping the longer
+# marked side at its pixel length and the table aspect ratio
+def table_size(corners, aspect=TABLE_ASPECT):
+    tl, tr, br, bl = corners
+    horizontal = max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl))
+    vertical = max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr))
+    if horizontal >= vertical:
+        return int(round(horizontal)), int(round(horizontal / aspect))
+    return int(round(vertical / aspect)), int(round(vertical))
+
+
+# Maps the playing surface marked by four corners in the camera image to an
+# upright table image. The perspective correction and optional lens
+# undistortion are folded into one pair of remap tables built once, so each
+# frame is cropped and rectified with a single cv2.remap over table pixels only.
+# The table image is always landscape, because the physics puts the side
+# pockets on the top and bottom rails: a table marked upright in the camera
+# image is turned on its side.
+class TableCalibration:
+    # corners: top left, top right, bottom right, bottom left in camera pixels
+    def __init__(self, corners, width=None, height=None, cameraMatrix=None, distCoeffs=None):
+        self.corners = np.float32(corners).reshape(4, 2)
+        self.cameraMatrix = None if cameraMatrix is None else np.float64(cameraMatrix).reshape(3, 3)
+        self.distCoeffs = None if distCoeffs is None else np.float64(distCoeffs).reshape(-1)
+        if width is None or height is None:
+            width, height = table_size(self.corners)
+        if height > width:
+            # Start at the bottom left corner to turn the table a quarter clockwise
+            self.corners = np.roll(self.corners, 1, axis=0)
+            width, height = height, width
+        self.width = int(width)
+        self.height = int(height)
+        self.map1 = None
+        self.map2 = None
+        self.build()
+
+    def hasLens(self):
+        return self.cameraMatrix is not None and self.distCoeffs is not None
+
+    # Corners with lens distortion removed
+    def undistortedCorners(self):
+        if not self.hasLens():
+            return self.corners
+        return cv2.undistortPoints(self.corners.reshape(-1, 1, 2), self.cameraMatrix,
+                                   self.distCoeffs, P=self.cameraMatrix).reshape(4, 2)
+
+    def build(self):
+        w, h = self.width, self.height
+        target = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+        inverse = cv2.getPerspectiveTransform(target, self.undistortedCorners())
+        xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        points = cv2.perspectiveTransform(np.dstack([xs, ys]).reshape(-1, 1, 2), inverse)
+        if self.hasLens():
+            # Move the undistorted points back to raw camera pixels
+            fx, fy = self.cameraMatrix[0, 0], self.cameraMatrix[1, 1]
+            cx, cy = self.cameraMatrix[0, 2], self.cameraMatrix[1, 2]
+            rays = np.ones((len(points), 1, 3), np.float64)
+            rays[:, 0, 0] = (points[:, 0, 0] - cx) / fx
+            rays[:, 0, 1] = (points[:, 0, 1] - cy) / fy
+            points, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3),
+                                          self.cameraMatrix, self.distCoeffs)
+        mapXY = points.reshape(h, w, 2).astype(np.float32)
+        self.map1, self.map2 = cv2.convertMaps(mapXY, None, cv2.CV_16SC2)
+
+    # Crop and rectify the table from a camera frame
+    def rectify(self, frame, dst=None):
+        return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR, dst=dst)
+
+    def toDict(self):
+        data = {
+            'corners': self.corners.tolist(),
+            'width': self.width,
+            'height': self.height
+        }
+        if self.hasLens():
+            data['cameraMatrix'] = self.cameraMatrix.tolist()
+            data['distCoeffs'] = self.distCoeffs.tolist()
+        return data
+
+    def save(self, filename=CALIBRATION_FILE):
+        with open(filename, "w+") as file:
+            json.dump(self.toDict(), file)
+
+    # Load a saved calibration, or None if the table has not been calibrated
+    @staticmethod
+    def load(filename=CALIBRATION_FILE):
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as file:
+            data = json.load(file)
+        return TableCalibration(data['corners'], data.get('width'), data.get('height'),
+                                data.get('cameraMatrix'), data.get('distCoeffs'))
+
+    @staticmethod
+    def remove(filename=CALIBRATION_FILE):
+        if os.path.exists(filename):
+            os.remove(filename)
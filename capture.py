@@ -0,0 +1,141 @@
+import threading
+import time
+import cv2
+
+# Number of frame slots the capture thread cycles through
+BUFFER_SIZE = 3
+# Seconds to wait for the first frame when starting
+START_TIMEOUT = 5
+
+
+# Reads frames from a cv2.VideoCapture on a background thread.
+# Only the newest frame is kept for the GUI; frames that are replaced before
+# anyone reads them are counted as dropped.
+class CameraCapture:
+    def __init__(self, source, bufferSize=BUFFER_SIZE):
+        self.source = source
+        self.bufferSize = max(bufferSize, 2)
+        self.slots = [None] * self.bufferSize
+        self.raw = [None] * self.bufferSize
+        self.timestamps = [0.0] * self.bufferSize
+        self.latestSlot = -1
+        self.latestIndex = -1
+        self.lastReadIndex = -1
+        self.ok = False
+        self.captured = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.firstFrame = threading.Event()
+        self.running = False
+        self.thread = None
+        self.transform = None
+        self.transformSize = None
+        # Bumped by setTransform so frames transformed the old way are dropped
+        self.transformEpoch = 0
+
+        # Query camera properties once, before the thread owns the camera
+        self.properties = {
+            cv2.CAP_PROP_FRAME_WIDTH: source.get(cv2.CAP_PROP_FRAME_WIDTH),
+            cv2.CAP_PROP_FRAME_HEIGHT: source.get(cv2.CAP_PROP_FRAME_HEIGHT),
+            cv2.CAP_PROP_FPS: source.get(cv2.CAP_PROP_FPS),
+        }
+
+    def start(self, timeout=START_TIMEOUT):
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.firstFrame.wait(timeout)
+        return self
+
+    def run(self):
+        slot = 0
+        while self.running:
+            # Never write into the slot the GUI may be copying from
+            if slot == self.latestSlot:
+                slot = (slot + 1) % self.bufferSize
+            ret, raw = self.source.read(self.raw[slot])
+            if not ret:
+                self.ok = False
+                self.firstFrame.set()
+                time.sleep(0.01)
+                continue
+            timestamp = time.monotonic()
+            with self.lock:
+                transform, epoch = self.transform, self.transformEpoch
+            if transform is None:
+                frame = raw
+            else:
+                dst = self.slots[slot] if self.slots[slot] is not raw else None
+                frame = transform(raw, dst)
+            with self.lock:
+                if epoch != self.transformEpoch:
+                    # Transformed with the old transform while it was changed
+                    continue
+                self.raw[slot] = raw
+                self.slots[slot] = frame
+                self.timestamps[slot] = timestamp
+                if self.latestIndex > self.lastReadIndex:
+                    self.dropped += 1
+                self.latestSlot = slot
+                self.latestIndex += 1
+                self.captured += 1
+                self.ok = True
+            self.firstFrame.set()
+            slot = (slot + 1) % self.bufferSize
+
+    # Apply transform(frame, dst) to every frame on the capture thread, e.g. to
+    # rectify the table. size is the (width, height) of transformed frames.
+    # The newest frame is transformed again straight away, so latest() never
+    # returns a frame from before the change.
+    def setTransform(self, transform, size=None):
+        with self.lock:
+            self.transform = transform
+            self.transformSize = size if transform is not None else None
+            self.transformEpoch += 1
+            if self.latestSlot >= 0:
+                raw = self.raw[self.latestSlot]
+                self.slots[self.latestSlot] = raw if transform is None else transform(raw, None)
+
+    # Return the newest frame with its capture time and index without blocking.
+    # The frame is a copy so callers can draw on it. With raw the untransformed
+    # camera frame is returned.
+    def latest(self, raw=False):
+        with self.lock:
+            if self.latestSlot < 0:
+                return None, 0.0, -1
+            frame = (self.raw if raw else self.slots)[self.latestSlot].copy()
+            timestamp = self.timestamps[self.latestSlot]
+            self.lastReadIndex = self.latestIndex
+            return frame, timestamp, self.latestIndex
+
+    # Drop-in replacement for cv2.VideoCapture.read
+    def read(self):
+        frame, _, _ = self.latest()
+        return self.ok and frame is not None, frame
+
+    # Frame properties as seen by the pages, after any transform
+    def get(self, prop):
+        if self.transformSize is not None:
+            if prop == cv2.CAP_PROP_FRAME_WIDTH:
+                return self.transformSize[0]
+            if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+                return self.transformSize[1]
+        if prop in self.properties:
+            return self.properties[prop]
+        return self.source.get(prop)
+
+    def stats(self):
+        with self.lock:
+            return {'captured': self.captured, 'dropped': self.dropped}
+
+    def report(self):
+        return "Capture: {captured} frames captured, {dropped} dropped unread".format(**self.stats())
+
+    def release(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+        self.source.release()
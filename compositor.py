@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+from PIL import Image
+from PIL import ImageTk
+
+
+# Composites camera frames with their overlays and paints them into a Tk label.
+# Translucent overlays are drawn into one shared layer that is blended once per
+# frame, and the RGBA buffer, PIL image and PhotoImage are reused between frames.
+# Finished frames are also published to an optional spectator stream.
+class Compositor:
+    def __init__(self, label, stream=None):
+        self.label = label
+        self.stream = stream
+        self.overlay = None
+        self.overlayUsed = False
+        self.rgba = None
+        self.image = None
+        self.photo = None
+
+    # Cleared layer the size of the frame for translucent overlays
+    def layer(self, frame):
+        if self.overlay is None or self.overlay.shape != frame.shape:
+            self.overlay = np.zeros_like(frame)
+        self.overlayUsed = True
+        return self.overlay
+
+    # Blend the overlay layer (and an optional ghost image) into a BGR frame
+    # in place and paint the result
+    def present(self, frame, alpha=1.0, ghost=None, ghostAlpha=0.0):
+        if self.overlayUsed:
+            cv2.addWeighted(frame, 1, self.overlay, alpha, 0, dst=frame)
+            self.overlay.fill(0)
+            self.overlayUsed = False
+        if ghost is not None and ghostAlpha > 0 and ghost.shape == frame.shape:
+            cv2.addWeighted(frame, 1, ghost, ghostAlpha, 0, dst=frame)
+
+        (h, w) = frame.shape[:2]
+        if self.rgba is None or self.rgba.shape[:2] != (h, w):
+            # The PIL image shares memory with the RGBA buffer
+            self.rgba = np.empty((h, w, 4), np.uint8)
+            self.image = Image.frombuffer('RGBA', (w, h), self.rgba, 'raw', 'RGBA', 0, 1)
+            self.photo = ImageTk.PhotoImage(image=self.image)
+            self.label.imgtk = self.photo
+            self.label.configure(image=self.photo)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA, dst=self.rgba)
+        self.photo.paste(self.image)
+        if self.stream is not None:
+            self.stream.publish(frame)
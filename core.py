@@ -0,0 +1,110 @@
+import json
+import threading
+from types import SimpleNamespace
+import cv2
+import pymunk
+from detection import BallDetector, BallTracker, MotionGate, DETECTION_SCALE
+from capture import CameraCapture
+from sources import open_source, NATIVE
+from physics import add_table
+from calibration import TableCalibration, CALIBRATION_FILE
+from recorder import is_rectified
+
+CAMERA_PORT = 0
+# Seconds to wait for the frame source to open
+OPEN_TIMEOUT = 30
+# Ball HSV ranges saved from the settings page
+DATA_FILE = 'data.txt'
+
+
+# Load ball HSV ranges from the settings data file
+def load_balls(filename=DATA_FILE):
+    with open(filename) as file:
+        data = json.load(file)
+    ballObjects = []
+    for entry in data['balls']:
+        for name, values in entry.items():
+            ballObjects.append(SimpleNamespace(
+                name=name, **{key: int(value) for key, value in values.items()}))
+    return ballObjects
+
+
+# Frame source, ball detection and physics world of one table, without any
+# GUI. Nothing is opened or built at construction: the frame source opens on a
+# background thread from open(), and the physics world is built on first use,
+# so the core can be imported and created in workers and benchmarks.
+class PoolCore:
+    def __init__(self, ballObjects, scale=DETECTION_SCALE, white=None, minRadius=0,
+                 tracking=True, motionGate=True):
+        self.detector = BallDetector(ballObjects, scale, white)
+        self.tracker = BallTracker(self.detector, minRadius, enabled=tracking,
+                                   gate=MotionGate() if motionGate else None)
+        self.cap = None
+        self.opened = threading.Event()
+        self.openError = None
+        self.calibration = None
+        self.space = None
+        self.walls = []
+        # Frame size after rectification, cached once the source is open
+        self.width = 0
+        self.height = 0
+
+    # Start opening a camera port, video file or image directory on a
+    # background thread, then apply the saved table calibration, if any.
+    # Recordings of rectified frames are replayed as they are.
+    def open(self, source=CAMERA_PORT, replay=NATIVE, calibrationFile=CALIBRATION_FILE):
+        if is_rectified(source):
+            calibrationFile = None
+
+        def run():
+            try:
+                # Calibrate before the first frame, so every frame has the table's size
+                self.cap = CameraCapture(open_source(source, replay))
+                self.applyCalibration(
+                    TableCalibration.load(calibrationFile) if calibrationFile else None)
+                self.cap.start()
+            except Exception as error:
+                self.openError = error
+            finally:
+                self.opened.set()
+        threading.Thread(target=run, daemon=True).start()
+        return self
+
+    # The running capture, waiting for the source to finish opening
+    def capture(self, timeout=OPEN_TIMEOUT):
+        if not self.opened.wait(timeout):
+            raise RuntimeError("Frame source did not open in {} s".format(timeout))
+        if self.openError is not None:
+            raise self.openError
+        return self.cap
+
+    # Rectify frames with a table calibration (or none), cache the frame size
+    # and move the walls and pockets to the new table
+    def applyCalibration(self, calibration):
+        self.calibration = calibration
+        if calibration is None:
+            self.cap.setTransform(None)
+        else:
+            self.cap.setTransform(calibration.rectify, (calibration.width, calibration.height))
+        self.width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        if self.space is not None:
+            self.buildTable()
+        self.tracker.reset()
+
+    def buildTable(self):
+        if self.walls:
+            self.space.remove(*self.walls)
+        self.walls = add_table(self.space, self.width, self.height)
+
+    # The physics world, built with the table walls on first use
+    def getSpace(self):
+        if self.space is None:
+            self.capture()
+            self.space = pymunk.Space()
+            self.buildTable()
+        return self.space
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
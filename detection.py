@@ -0,0 +1,491 @@
+import math
+import time
+import cv2
+import numpy as np
+from timing import profiler
+
+# Kernel used to clean up ball masks
+KERNEL = np.ones((5, 5), np.uint8)
+# Frames between full-frame searches while balls are being tracked
+REACQUIRE_INTERVAL = 30
+# Tracking window half-size as a multiple of the ball radius
+WINDOW_SCALE = 2.0
+# Frame scale used to find candidate balls, 1 searches at full resolution
+DETECTION_SCALE = 1.0
+# Smallest radius in pixels counted as a ball by the game and the tools
+MIN_RADIUS = 10
+# Color of the cue ball, which tells stripes from solids
+CUE_BALL = 'White'
+# Refinement window half-size as a multiple of the coarse radius
+REFINE_SCALE = 1.5
+# Percentiles of a clicked patch used for the calibrated HSV range
+CALIBRATION_PERCENTILES = (5, 95)
+# Extra (h, s, v) added on both sides of the calibrated range
+CALIBRATION_MARGIN = (4, 30, 40)
+# Share of white pixels inside a colored ball above which it is a stripe
+STRIPE_RATIO = 0.25
+# Largest move between frames, as a multiple of the radius, that keeps a
+# ball's identity
+MATCH_SCALE = 4.0
+# Width of the grayscale thumbnail compared to spot motion
+MOTION_WIDTH = 96
+# Gray level change that counts a thumbnail pixel as moving
+MOTION_THRESHOLD = 16
+# Moving pixels near the balls that wake detection up
+MOTION_PIXELS = 2
+# Motion is looked for within this multiple of each ball's radius
+MOTION_MARGIN = 2.0
+# Seconds after which a still table is detected again anyway
+IDLE_TIMEOUT = 1.0
+
+
+# Index of the cue ball's color in a list of ball color names, or None
+def cue_index(names):
+    return names.index(CUE_BALL) if CUE_BALL in names else None
+
+
+# Label stored for every bitmask: the lowest set bit wins so the ball
+# listed first takes priority where HSV ranges overlap
+LOWEST_BIT = np.array([(value & -value).bit_length() for value in range(256)], np.uint8)
+
+
+# Build the HSV to label lookup tables for a list of (hMin, hMax, sMin, sMax,
+# vMin, vMax) ranges. Each channel maps to a bitmask of the balls whose range
+# contains it, so a pixel's label is the AND of its three channel masks.
+# Balls are packed eight to a group, one bit per ball.
+def build_label_luts(ranges):
+    luts = []
+    for start in range(0, len(ranges), 8):
+        hLut = np.zeros(256, np.uint8)
+        sLut = np.zeros(256, np.uint8)
+        vLut = np.zeros(256, np.uint8)
+        for bit, (hMin, hMax, sMin, sMax, vMin, vMax) in enumerate(ranges[start:start + 8]):
+            hLut[hMin:hMax + 1] |= 1 << bit
+            sLut[sMin:sMax + 1] |= 1 << bit
+            vLut[vMin:vMax + 1] |= 1 << bit
+        labelLut = np.where(LOWEST_BIT > 0, LOWEST_BIT + start, 0).astype(np.uint8)
+        luts.append((hLut, sLut, vLut, labelLut))
+    return luts
+
+
+# Convert a BGR frame to HSV once and classify every pixel with the lookup tables
+def label_image(frame, luts):
+    with profiler.stage('hsv'):
+        h, s, v = cv2.split(cv2.cvtColor(frame, cv2.COLOR_BGR2HSV))
+        labels = None
+        for hLut, sLut, vLut, labelLut in luts:
+            bits = cv2.LUT(h, hLut)
+            cv2.bitwise_and(bits, cv2.LUT(s, sLut), dst=bits)
+            cv2.bitwise_and(bits, cv2.LUT(v, vLut), dst=bits)
+            groupLabels = cv2.LUT(bits, labelLut)
+            if labels is None:
+                labels = groupLabels
+            else:
+                unlabelled = labels == 0
+                labels[unlabelled] = groupLabels[unlabelled]
+        if labels is None:
+            labels = np.zeros(h.shape, np.uint8)
+        return labels
+
+
+# Split the labelled pixels into contours, one set per label. Noise is removed
+# with a single opening pass over all colors and every connected blob is then
+# split by label so touching balls of different colors separate.
+# Returns a list of (label, contour) pairs, labels starting at 1.
+def label_contours(labels, count, kernel=KERNEL):
+    with profiler.stage('morphology'):
+        mask = cv2.morphologyEx((labels > 0).astype(np.uint8), cv2.MORPH_OPEN, kernel)
+    with profiler.stage('contours'):
+        return split_contours(labels, mask, count, kernel)
+
+
+def split_contours(labels, mask, count, kernel):
+    blobs = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    found = []
+    pad = max(kernel.shape)
+    height, width = labels.shape[:2]
+    for blob in blobs:
+        x, y, w, h = cv2.boundingRect(blob)
+        x0, y0 = max(x - pad, 0), max(y - pad, 0)
+        x1, y1 = min(x + w + pad, width), min(y + h + pad, height)
+        patch = labels[y0:y1, x0:x1]
+        inside = np.zeros(patch.shape, np.uint8)
+        cv2.drawContours(inside, [blob], -1, 1, cv2.FILLED, offset=(-x0, -y0))
+        inside = (inside > 0) & (mask[y0:y1, x0:x1] > 0)
+
+        for k in np.unique(patch[inside]):
+            if k == 0 or k > count:
+                continue
+            part = np.where(inside & (patch == k), 255, 0).astype(np.uint8)
+            part = cv2.morphologyEx(part, cv2.MORPH_CLOSE, kernel)
+            contours = cv2.findContours(
+                part, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))[-2]
+            found.extend((k, contour) for contour in contours)
+    return found
+
+
+# Enclosing circle and centroid of a contour as (x, y, radius, center)
+def contour_circle(contour):
+    (x, y), radius = cv2.minEnclosingCircle(contour)
+    M = cv2.moments(contour)
+    if M["m00"] > 0:
+        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+    else:
+        center = (int(x), int(y))
+    return x, y, radius, center
+
+
+# A ball found in a frame. label is the index of its color and stripe is set
+# for colored balls with enough white inside them.
+class Blob:
+    def __init__(self, label, x, y, r, center, stripe=False):
+        self.label = label
+        self.x = x
+        self.y = y
+        self.r = r
+        self.center = center
+        self.stripe = stripe
+
+    def shifted(self, dx, dy):
+        return Blob(self.label, self.x + dx, self.y + dy, self.r,
+                    (self.center[0] + dx, self.center[1] + dy), self.stripe)
+
+
+# Fraction of the pixels inside a blob's circle that carry the white label
+def white_ratio(labels, blob, whiteValue):
+    height, width = labels.shape[:2]
+    x0, y0 = max(int(blob.x - blob.r), 0), max(int(blob.y - blob.r), 0)
+    x1, y1 = min(int(blob.x + blob.r) + 1, width), min(int(blob.y + blob.r) + 1, height)
+    if x1 <= x0 or y1 <= y0:
+        return 0.0
+    ys, xs = np.ogrid[y0:y1, x0:x1]
+    circle = (xs - blob.x) ** 2 + (ys - blob.y) ** 2 <= blob.r ** 2
+    area = np.count_nonzero(circle)
+    if area == 0:
+        return 0.0
+    return np.count_nonzero(labels[y0:y1, x0:x1][circle] == whiteValue) / area
+
+
+# Find every ball in a label image, any number per color, as a list of Blobs.
+# When the index of the white (cue ball) color is given, colored balls are
+# marked as stripes by their white pixel ratio, and white blobs lying inside a
+# colored ball are dropped as its stripe or number rather than a cue ball.
+def extract_blobs(labels, count, kernel=KERNEL, white=None, minRadius=0,
+                  stripeRatio=STRIPE_RATIO):
+    contours = label_contours(labels, count, kernel)
+    with profiler.stage('fitting'):
+        return fit_blobs(labels, contours, white, minRadius, stripeRatio)
+
+
+def fit_blobs(labels, contours, white, minRadius, stripeRatio):
+    found = []
+    for k, contour in contours:
+        x, y, radius, center = contour_circle(contour)
+        if radius > minRadius:
+            found.append(Blob(int(k) - 1, x, y, radius, center))
+    if white is None:
+        return found
+
+    colored = [blob for blob in found if blob.label != white]
+    for blob in colored:
+        blob.stripe = bool(white_ratio(labels, blob, white + 1) >= stripeRatio)
+    cueBalls = [blob for blob in found if blob.label == white and not any(
+        math.hypot(blob.x - ball.x, blob.y - ball.y) < ball.r for ball in colored)]
+    return colored + cueBalls
+
+
+# Blob of a color (and pattern, unless stripe is None) closest to (x, y)
+def nearest_blob(blobs, label, x, y, stripe=None):
+    best = None
+    bestDistance = 0
+    for blob in blobs:
+        if blob.label != label or (stripe is not None and blob.stripe != stripe):
+            continue
+        distance = math.hypot(blob.x - x, blob.y - y)
+        if best is None or distance < bestDistance:
+            best = blob
+            bestDistance = distance
+    return best
+
+
+# Every ball in a window of half-size `half` around (cx, cy), in frame coordinates
+def blobs_in_window(frame, luts, count, cx, cy, half, kernel=KERNEL, white=None, minRadius=0):
+    height, width = frame.shape[:2]
+    x0, y0 = max(int(cx) - half, 0), max(int(cy) - half, 0)
+    x1, y1 = min(int(cx) + half, width), min(int(cy) + half, height)
+    if x1 <= x0 or y1 <= y0:
+        return []
+    labels = label_image(frame[y0:y1, x0:x1], luts)
+    return [blob.shifted(x0, y0)
+            for blob in extract_blobs(labels, count, kernel, white, minRadius)]
+
+
+# Square morphology kernel scaled down with the frame, odd sized
+def scaled_kernel(scale):
+    size = max(int(round(KERNEL.shape[0] * scale)), 1) | 1
+    return np.ones((size, size), np.uint8)
+
+
+# Detects every ball color in a frame with one HSV conversion and one labelling pass.
+# With a scale below 1 balls are found on a downscaled frame first and their
+# center and radius refined in small full resolution windows.
+# white is the index of the cue ball color, used to tell stripes from solids.
+class BallDetector:
+    def __init__(self, ballObjects, scale=DETECTION_SCALE, white=None):
+        self.ballObjects = ballObjects
+        self.scale = scale
+        self.white = white
+        self.ranges = None
+        self.luts = None
+
+    def getRanges(self):
+        return tuple((b.hMin, b.hMax, b.sMin, b.sMax, b.vMin, b.vMax)
+                     for b in self.ballObjects)
+
+    # Rebuild the lookup tables only when the HSV settings have changed.
+    # Returns whether they were rebuilt.
+    def refresh(self):
+        ranges = self.getRanges()
+        if ranges == self.ranges:
+            return False
+        self.luts = build_label_luts(ranges)
+        self.ranges = ranges
+        return True
+
+    def labels(self, frame):
+        self.refresh()
+        return label_image(frame, self.luts)
+
+    # Every ball in the frame as a list of Blobs, any number per color
+    def detectAll(self, frame, minRadius=0):
+        count = len(self.ballObjects)
+        if self.scale >= 1:
+            return extract_blobs(self.labels(frame), count, KERNEL, self.white, minRadius)
+
+        small = cv2.resize(frame, None, fx=self.scale, fy=self.scale,
+                           interpolation=cv2.INTER_AREA)
+        coarse = extract_blobs(self.labels(small), count, scaled_kernel(self.scale),
+                               self.white, minRadius * self.scale)
+        pad = max(KERNEL.shape)
+        results = []
+        for candidate in coarse:
+            x, y, r = candidate.x / self.scale, candidate.y / self.scale, candidate.r / self.scale
+            half = int(REFINE_SCALE * r + 1 / self.scale) + pad
+            refined = nearest_blob(blobs_in_window(frame, self.luts, count, x, y, half,
+                                                   KERNEL, self.white, minRadius),
+                                   candidate.label, x, y)
+            if refined is None:
+                # Keep the coarse estimate when the window misses
+                refined = Blob(candidate.label, x, y, r, (int(x), int(y)), candidate.stripe)
+            results.append(refined)
+        return results
+
+
+# A ball followed from frame to frame: its identity, color and pattern, last
+# known position and per-frame velocity
+class Track:
+    def __init__(self, id, blob):
+        self.id = id
+        self.label = blob.label
+        self.stripe = blob.stripe
+        self.x = blob.x
+        self.y = blob.y
+        self.r = blob.r
+        self.center = blob.center
+        self.vx = 0
+        self.vy = 0
+
+    def update(self, blob):
+        self.vx = blob.x - self.x
+        self.vy = blob.y - self.y
+        self.x = blob.x
+        self.y = blob.y
+        self.r = blob.r
+        self.center = blob.center
+
+    # Constant velocity prediction of the next position
+    def predict(self):
+        return self.x + self.vx, self.y + self.vy
+
+    def matches(self, blob):
+        return blob.label == self.label and blob.stripe == self.stripe
+
+
+# Tells whether a table has changed since the last detection by comparing tiny
+# grayscale thumbnails of the frames around the balls. Motion elsewhere, like
+# a player walking past, is ignored until the idle timeout.
+class MotionGate:
+    def __init__(self, width=MOTION_WIDTH, threshold=MOTION_THRESHOLD, minPixels=MOTION_PIXELS,
+                 margin=MOTION_MARGIN, timeout=IDLE_TIMEOUT):
+        self.width = width
+        self.threshold = threshold
+        self.minPixels = minPixels
+        self.margin = margin
+        self.timeout = timeout
+        self.reference = None
+        self.mask = None
+        self.thumbnail = None
+        self.detected = 0.0
+
+    def reset(self):
+        self.reference = None
+
+    def thumbnailOf(self, frame):
+        h, w = frame.shape[:2]
+        size = (self.width, max(int(round(h * self.width / w)), 1))
+        # Sampling every few pixels is enough and much cheaper than averaging
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    # Whether the frame needs a new detection
+    def changed(self, frame, now):
+        self.thumbnail = self.thumbnailOf(frame)
+        if self.reference is None or now - self.detected >= self.timeout:
+            return True
+        moving = cv2.absdiff(self.thumbnail, self.reference) > self.threshold
+        return np.count_nonzero(moving & self.mask) >= self.minPixels
+
+    # Whether nothing has been detected for the idle timeout
+    def expired(self, now):
+        return self.reference is not None and now - self.detected >= self.timeout
+
+    # Remember the balls of a new detection on the frame last passed to changed
+    def update(self, frame, tracks, now):
+        self.reference = self.thumbnail
+        scale = self.width / frame.shape[1]
+        mask = np.zeros(self.reference.shape, np.uint8)
+        for track in tracks:
+            cv2.circle(mask, (int(track.x * scale), int(track.y * scale)),
+                       int(self.margin * track.r * scale) + 1, 1, cv2.FILLED)
+        self.mask = mask > 0
+        self.detected = now
+
+
+# Follows every ball on the table and keeps its identity between frames.
+# Full-frame detections are matched to the tracks of the same color and
+# pattern, closest pairs first. While tracking, each ball is searched only in
+# a small window around its predicted position. Falls back to a full-frame
+# search when a tracked ball is lost and every `interval` frames to pick up
+# new balls. With a MotionGate the last tracks are returned as they are while
+# nothing moves near the balls.
+class BallTracker:
+    def __init__(self, detector, minRadius=0, interval=REACQUIRE_INTERVAL,
+                 windowScale=WINDOW_SCALE, enabled=True, matchScale=MATCH_SCALE, gate=None):
+        self.detector = detector
+        self.minRadius = minRadius
+        self.interval = interval
+        self.windowScale = windowScale
+        self.enabled = enabled
+        self.matchScale = matchScale
+        self.gate = gate
+        self.tracks = None
+        self.nextId = 0
+        self.sinceFull = 0
+        self.skipped = 0
+
+    def reset(self):
+        self.tracks = None
+        if self.gate is not None:
+            self.gate.reset()
+
+    # Give each blob the identity of the closest matching track within reach.
+    # Blobs left over start new tracks, tracks left over are dropped.
+    def assign(self, blobs):
+        byClass = {}
+        for j, blob in enumerate(blobs):
+            byClass.setdefault((blob.label, blob.stripe), []).append(j)
+
+        tracks = self.tracks or []
+        pairs = []
+        for i, track in enumerate(tracks):
+            px, py = track.predict()
+            reach = self.matchScale * track.r + abs(track.vx) + abs(track.vy)
+            for j in byClass.get((track.label, track.stripe), ()):
+                distance = math.hypot(blobs[j].x - px, blobs[j].y - py)
+                if distance <= reach:
+                    pairs.append((distance, i, j))
+        pairs.sort()
+
+        matched = {}
+        used = set()
+        for distance, i, j in pairs:
+            if i not in matched and j not in used:
+                matched[i] = j
+                used.add(j)
+
+        result = []
+        for i, track in enumerate(tracks):
+            if i in matched:
+                track.update(blobs[matched[i]])
+                result.append(track)
+        for j, blob in enumerate(blobs):
+            if j not in used:
+                result.append(Track(self.nextId, blob))
+                self.nextId += 1
+        self.tracks = result
+
+    def fullSearch(self, frame):
+        self.assign(self.detector.detectAll(frame, self.minRadius))
+        self.sinceFull = 0
+        return self.tracks
+
+    # Tracks of every ball currently on the table. now is the frame's time in
+    # seconds for the motion gate; offline callers pass the video time so the
+    # result does not depend on how fast frames are processed.
+    def detect(self, frame, now=None):
+        if self.gate is None:
+            return self.track(frame)
+        if now is None:
+            now = time.monotonic()
+        # New HSV settings must be seen straight away
+        if self.detector.refresh():
+            self.gate.reset()
+        if not self.gate.changed(frame, now) and self.tracks is not None:
+            self.skipped += 1
+            return self.tracks
+        # The frames the gate skipped never count towards the periodic full
+        # search, so balls added away from the tracks are looked for on timeout
+        if self.gate.expired(now):
+            tracks = self.fullSearch(frame)
+        else:
+            tracks = self.track(frame)
+        self.gate.update(frame, tracks, now)
+        return tracks
+
+    def track(self, frame):
+        if not self.enabled or self.tracks is None or self.sinceFull >= self.interval:
+            return self.fullSearch(frame)
+
+        self.detector.refresh()
+        count = len(self.detector.ballObjects)
+        pad = max(KERNEL.shape)
+        for track in self.tracks:
+            px, py = track.predict()
+            half = int(self.windowScale * track.r + abs(track.vx) + abs(track.vy)) + pad
+            blobs = blobs_in_window(frame, self.detector.luts, count, px, py, half,
+                                    KERNEL, self.detector.white, self.minRadius)
+            found = nearest_blob(blobs, track.label, px, py, track.stripe)
+            if found is None:
+                # Lost the ball, search the whole frame again
+                return self.fullSearch(frame)
+            track.update(found)
+        self.sinceFull += 1
+        return self.tracks
+
+
+# HSV range (hMin, hMax, sMin, sMax, vMin, vMax) covering most of a patch of
+# HSV pixels, widened by a margin. Hue is circular, so when the patch straddles
+# red at 0/179 the range is fitted to whichever side holds most pixels.
+def hsv_range_from_pixels(pixels, low=CALIBRATION_PERCENTILES[0],
+                          high=CALIBRATION_PERCENTILES[1], margin=CALIBRATION_MARGIN):
+    pixels = pixels.reshape(-1, 3).astype(np.int32)
+    hue = pixels[:, 0]
+    if np.percentile(hue, high) - np.percentile(hue, low) > 90:
+        upper = hue >= 90
+        pixels = pixels[upper] if upper.sum() * 2 >= len(hue) else pixels[~upper]
+    result = []
+    for channel, (limit, extra) in enumerate(zip((179, 255, 255), margin)):
+        values = pixels[:, channel]
+        result.append(max(int(np.percentile(values, low)) - extra, 0))
+        result.append(min(int(np.percentile(values, high)) + extra, limit))
+    return tuple(result)
@@ -0,0 +1,103 @@
+import json
+import math
+import os
+import cv2
+import numpy as np
+
+LIBRARY_FILE = 'layouts.jsonl'
+# Coordinate used for a ball that is not on the table
+MISSING = -1.0
+# Libraries smaller than this are searched by brute force
+INDEX_THRESHOLD = 2000
+# Layouts added since the last index build are searched by brute force
+# until there are this many of them
+REINDEX_COUNT = 1000
+KDTREE_PARAMS = dict(algorithm=1, trees=4)
+SEARCH_PARAMS = dict(checks=128)
+
+
+# Persistent library of ball layouts with nearest neighbour search.
+# A layout is a dict of ball name to (x, y, r). Layouts are appended to a
+# JSON lines file and indexed as vectors of normalised ball positions.
+class LayoutLibrary:
+    def __init__(self, names, filename=LIBRARY_FILE):
+        self.names = list(names)
+        self.filename = filename
+        self.records = []
+        self.vectors = np.empty((64, 2 * len(self.names)), np.float32)
+        self.index = None
+        self.indexed = 0
+        self.load()
+
+    def __len__(self):
+        return len(self.records)
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    self.append(json.loads(line))
+
+    # Feature vector of a layout: each ball's position as a fraction of the frame
+    def vector(self, layout, width, height):
+        v = np.full(2 * len(self.names), MISSING, np.float32)
+        for i, name in enumerate(self.names):
+            if name in layout:
+                x, y = layout[name][:2]
+                v[2 * i] = x / width
+                v[2 * i + 1] = y / height
+        return v
+
+    def append(self, record):
+        count = len(self.records)
+        if count == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+        self.vectors[count] = self.vector(record['balls'], record['width'], record['height'])
+        self.records.append(record)
+
+    # Store a layout and return its record
+    def add(self, layout, width, height, time=None):
+        record = {
+            'id': len(self.records),
+            'time': time,
+            'width': width,
+            'height': height,
+            'balls': {name: [float(value) for value in layout[name]]
+                      for name in self.names if name in layout}
+        }
+        with open(self.filename, "a") as file:
+            file.write(json.dumps(record) + "\n")
+        self.append(record)
+        return record
+
+    def buildIndex(self):
+        count = len(self.records)
+        self.index = cv2.flann_Index(self.vectors[:count], KDTREE_PARAMS)
+        self.indexed = count
+
+    # The k stored layouts closest to a layout, as (distance, record) pairs
+    def nearest(self, layout, width, height, k=5):
+        count = len(self.records)
+        if count == 0:
+            return []
+        if count >= INDEX_THRESHOLD and count - self.indexed >= REINDEX_COUNT:
+            self.buildIndex()
+
+        query = self.vector(layout, width, height)
+        matches = []
+        start = 0
+        if self.index is not None:
+            indices, distances = self.index.knnSearch(
+                query.reshape(1, -1), min(k, self.indexed), params=SEARCH_PARAMS)
+            matches.extend(zip(distances[0], indices[0]))
+            start = self.indexed
+        if start < count:
+            # Layouts not in the index yet
+            distances = ((self.vectors[start:count] - query) ** 2).sum(axis=1)
+            for i in np.argsort(distances)[:k]:
+                matches.append((distances[i], start + i))
+        matches.sort()
+        return [(math.sqrt(distance), self.records[i]) for distance, i in matches[:k]]
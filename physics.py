@@ -0,0 +1,184 @@
+import numpy as np
+import pymunk
+
+# Mass of every ball
+MASS = 10
+# Seconds of simulated time per physics step
+TIME_STEP = 0.01
+# Balls slower than this (pixels per second) count as stopped
+REST_SPEED = 1.0
+# Seconds a ball must stay below REST_SPEED before it is put to sleep
+SLEEP_TIME = 0.2
+# Pocket radius as a fraction of the table length
+POCKET_SCALE = 0.03
+# Collision types
+BALL_TYPE = 1
+POCKET_TYPE = 2
+# Longest shot that will be simulated, in seconds
+MAX_SHOT_TIME = 30.0
+
+
+# Pocket positions of a width x height table: four corners and two side pockets
+def pockets(width, height):
+    return [(0, 0), (width / 2, 0), (width, 0),
+            (0, height), (width / 2, height), (width, height)]
+
+
+def pocket_radius(width, height):
+    return POCKET_SCALE * max(width, height)
+
+
+# Add the four table walls around a width x height frame, leaving a gap of
+# `gap` pixels either side of every pocket
+def add_walls(space, width, height, gap=0):
+    if gap:
+        segments = [((1, 1 + gap), (1, height - gap)), ((width, 1 + gap), (width, height - gap))]
+        for y in (1, height):
+            segments.append(((1 + gap, y), (width / 2 - gap, y)))
+            segments.append(((width / 2 + gap, y), (width - gap, y)))
+    else:
+        segments = [((1, 1), (1, height)), ((1, 1), (width, 1)),
+                    ((width, 1), (width, height)), ((1, height), (width, height))]
+    walls = []
+    for a, b in segments:
+        shape = pymunk.Segment(space.static_body, a, b, 1.0)
+        space.add(shape)
+        shape.elasticity = 1
+        shape.friction = 1
+        walls.append(shape)
+    return walls
+
+
+# Add a ball to a space. The pivot joint and motor to the static body act as
+# rolling and spinning friction. Returns (body, shape, pivot, motor).
+def add_ball(space, x, y, r):
+    moment = pymunk.moment_for_circle(MASS, 0, r)
+    body = pymunk.Body(MASS, moment)
+    body.position = x, y
+    shape = pymunk.Circle(body, r)
+    shape.elasticity = 0.7
+    shape.friction = 0.8
+    shape.collision_type = BALL_TYPE
+    piv = pymunk.constraints.PivotJoint(space.static_body, body, (0, 0), (0, 0))
+    piv.max_force = 1000
+    piv.max_bias = 0
+    mot = pymunk.constraints.SimpleMotor(space.static_body, body, 0)
+    mot.max_force = 50000000
+    space.add(body, shape, piv, mot)
+    return body, shape, piv, mot
+
+
+# Add a sensor at every pocket that reports touching balls instead of colliding
+def add_pockets(space, width, height, radius):
+    sensors = []
+    for position in pockets(width, height):
+        shape = pymunk.Circle(space.static_body, radius, position)
+        shape.sensor = True
+        shape.collision_type = POCKET_TYPE
+        space.add(shape)
+        sensors.append(shape)
+    return sensors
+
+
+# Add the walls and pockets of a width x height table. Returns the added shapes.
+def add_table(space, width, height):
+    radius = pocket_radius(width, height)
+    return add_walls(space, width, height, radius) + add_pockets(space, width, height, radius)
+
+
+# Remove a body with its shapes and constraints, used as a post step callback
+def remove_body(space, body):
+    if body.space is space:
+        space.remove(*body.shapes, *body.constraints, body)
+
+
+# Build an independent world from a layout of (x, y, r) balls.
+# Returns the space and the ball bodies in layout order.
+def build_world(layout, width, height):
+    space = pymunk.Space()
+    add_table(space, width, height)
+    bodies = [add_ball(space, x, y, r)[0] for x, y, r in layout]
+    return space, bodies
+
+
+# Per-ball positions of a resolved shot, one row per physics step, and the
+# step each pocketed ball went down (None for balls left on the table)
+class Trajectory:
+    def __init__(self, positions, dt=TIME_STEP, pocketed=None):
+        self.positions = positions
+        self.dt = dt
+        self.pocketed = pocketed if pocketed is not None else [None] * positions.shape[1]
+
+    @property
+    def duration(self):
+        return (len(self.positions) - 1) * self.dt
+
+    def stepAt(self, t):
+        return min(max(int(t / self.dt), 0), len(self.positions) - 1)
+
+    # Positions of every ball t seconds into the shot
+    def positionsAt(self, t):
+        return self.positions[self.stepAt(t)]
+
+    # Whether each ball is still on the table t seconds into the shot
+    def onTableAt(self, t):
+        step = self.stepAt(t)
+        return [pocket is None or step < pocket for pocket in self.pocketed]
+
+    def finalPositions(self):
+        return self.positions[-1]
+
+
+# Removes balls that touch a pocket and fires onFinished once every ball
+# has been pocketed or put to sleep by the space at the same time. Sleeping balls are not
+# simulated, so the space only spends time on balls that are still moving.
+class ShotMonitor:
+    def __init__(self, space, bodies, onPocket=None, onFinished=None,
+                 restSpeed=REST_SPEED, sleepTime=SLEEP_TIME):
+        self.space = space
+        self.bodies = bodies
+        self.onPocket = onPocket
+        self.onFinished = onFinished
+        self.steps = 0
+        self.pocketed = {}
+        self.finished = False
+        space.idle_speed_threshold = restSpeed
+        space.sleep_time_threshold = sleepTime
+        handler = space.add_collision_handler(BALL_TYPE, POCKET_TYPE)
+        handler.begin = self.pocket
+
+    def pocket(self, arbiter, space, data):
+        body = arbiter.shapes[0].body
+        if body not in self.pocketed:
+            self.pocketed[body] = self.steps
+            space.add_post_step_callback(remove_body, body)
+            if self.onPocket is not None:
+                self.onPocket(body)
+        return False
+
+    def step(self, dt=TIME_STEP):
+        self.space.step(dt)
+        self.steps += 1
+        # A sleeping ball wakes up again when another ball hits it
+        if not self.finished and all(body.is_sleeping or body in self.pocketed
+                                     for body in self.bodies):
+            self.finished = True
+            if self.onFinished is not None:
+                self.onFinished()
+
+
+# Step a space until every ball is pocketed or asleep, as fast as the CPU
+# allows, and return the recorded trajectory of the bodies
+def resolve_shot(space, bodies, dt=TIME_STEP, maxTime=MAX_SHOT_TIME, restSpeed=REST_SPEED):
+    maxSteps = int(maxTime / dt)
+    positions = np.empty((maxSteps + 1, len(bodies), 2), np.float32)
+    monitor = ShotMonitor(space, bodies, restSpeed=restSpeed)
+    positions[0] = [tuple(body.position) for body in bodies]
+    while monitor.steps < maxSteps and not monitor.finished:
+        monitor.step(dt)
+        positions[monitor.steps] = [tuple(body.position) for body in bodies]
+    for body in bodies:
+        body.velocity = (0, 0)
+        body.angular_velocity = 0
+    pocketed = [monitor.pocketed.get(body) for body in bodies]
+    return Trajectory(positions[:monitor.steps + 1].copy(), dt, pocketed)
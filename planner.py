@@ -0,0 +1,219 @@
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from physics import build_world, resolve_shot, pockets
+from batchphysics import simulate_shots
+
+# Number of shot directions tried around each cue ball
+DIRECTIONS = 72
+# Impulse strengths tried in every direction
+POWERS = (4000, 6000, 8000, 10000, 12000, 14000)
+# Seconds the planner may spend searching for a shot
+TIME_BUDGET = 1.0
+# Physics backends: one pymunk world per shot, or all shots of a task at once
+PYMUNK = 'pymunk'
+NUMPY = 'numpy'
+BACKENDS = (PYMUNK, NUMPY)
+# Candidate shots simulated per worker task
+BATCH_SIZE = 8
+VECTOR_BATCH_SIZE = 144
+POT_SCORE = 100
+SCRATCH_PENALTY = 150
+PROGRESS_SCORE = 10
+
+
+def pocket_distance(x, y, tablePockets):
+    return min(math.hypot(x - px, y - py) for px, py in tablePockets)
+
+
+# Score the end state of a shot. Pocketed object balls score most, then
+# object balls that moved closer to a pocket. Pocketing the cue ball is penalised.
+def score_shot(layout, final, pocketed, cueIndex, width, height):
+    tablePockets = pockets(width, height)
+    diagonal = math.hypot(width, height)
+    score = 0.0
+    for i, ((x0, y0, r), (x, y)) in enumerate(zip(layout, final)):
+        if i == cueIndex:
+            if pocketed[i] is not None:
+                score -= SCRATCH_PENALTY
+        elif pocketed[i] is not None:
+            score += POT_SCORE
+        else:
+            distance = pocket_distance(x, y, tablePockets)
+            score += PROGRESS_SCORE * (pocket_distance(x0, y0, tablePockets) - distance) / diagonal
+    return score
+
+
+# Simulate a batch of (cueIndex, impulse) shots, each in its own fresh world.
+# Runs in the worker processes, so it only takes plain data. Returns
+# (score, cueIndex, impulse, final, pocketed) for every shot.
+def evaluate_shots(layout, width, height, shots):
+    results = []
+    for cueIndex, impulse in shots:
+        space, bodies = build_world(layout, width, height)
+        body = bodies[cueIndex]
+        body.apply_impulse_at_world_point(impulse, body.position)
+        trajectory = resolve_shot(space, bodies)
+        final = [tuple(p) for p in trajectory.finalPositions()]
+        score = score_shot(layout, final, trajectory.pocketed, cueIndex, width, height)
+        results.append((score, cueIndex, impulse, final, trajectory.pocketed))
+    return results
+
+
+# Same as evaluate_shots with the vectorized solver, all shots advancing together
+def evaluate_batch(layout, width, height, shots):
+    if not shots:
+        return []
+    final, pocketed, _ = simulate_shots(layout, width, height,
+                                        [cueIndex for cueIndex, _ in shots],
+                                        [impulse for _, impulse in shots])
+    results = []
+    for k, (cueIndex, impulse) in enumerate(shots):
+        down = [None if step < 0 else int(step) for step in pocketed[k]]
+        positions = [tuple(point) for point in final[k].tolist()]
+        score = score_shot(layout, positions, down, cueIndex, width, height)
+        results.append((score, cueIndex, impulse, positions, down))
+    return results
+
+
+# Every direction x power combination for every cue ball, in a fixed random
+# order so a search cut short by the time budget still covers the table evenly
+def candidate_shots(cueIndices, directions=DIRECTIONS, powers=POWERS, seed=0):
+    shots = []
+    for cueIndex in cueIndices:
+        for d in range(directions):
+            angle = 2 * math.pi * d / directions
+            for power in powers:
+                shots.append((cueIndex, (power * math.cos(angle), power * math.sin(angle))))
+    random.Random(seed).shuffle(shots)
+    return shots
+
+
+# Outcome of a shot search
+class ShotResult:
+    def __init__(self, score, cueIndex, impulse, evaluated, seconds, cached=0):
+        self.score = score
+        self.cueIndex = cueIndex
+        self.impulse = impulse
+        self.evaluated = evaluated
+        self.seconds = seconds
+        self.cached = cached
+
+    @property
+    def candidatesPerSecond(self):
+        return self.evaluated / self.seconds if self.seconds > 0 else 0.0
+
+
+# Searches candidate shots in parallel across a pool of worker processes.
+# With a ShotCache, outcomes of shots already simulated on the same quantized
+# layout are scored straight from the cache and only the rest are simulated.
+class ShotPlanner:
+    def __init__(self, workers=None, timeBudget=TIME_BUDGET, directions=DIRECTIONS,
+                 powers=POWERS, batchSize=None, cache=None, backend=PYMUNK):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown physics backend: {}".format(backend))
+        self.workers = workers or os.cpu_count() or 1
+        self.timeBudget = timeBudget
+        self.directions = directions
+        self.powers = powers
+        self.backend = backend
+        self.evaluate = evaluate_batch if backend == NUMPY else evaluate_shots
+        if batchSize is None:
+            batchSize = VECTOR_BATCH_SIZE if backend == NUMPY else BATCH_SIZE
+        self.batchSize = batchSize
+        self.cache = cache
+        self.pool = None
+        self.thread = None
+
+    # Worker processes are started on first use
+    def getPool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self.pool
+
+    # Find the best shot for a layout of (x, y, r) balls, hitting one of the
+    # balls in cueIndices, within the time budget
+    def plan(self, layout, width, height, cueIndices):
+        start = time.monotonic()
+        deadline = start + self.timeBudget
+        shots = candidate_shots(cueIndices, self.directions, self.powers)
+        best = None
+        evaluated = 0
+        cached = 0
+        if self.cache is not None:
+            layout = self.cache.quantizeLayout(layout)
+            remaining = []
+            for cueIndex, impulse in shots:
+                outcome = self.cache.get(self.cache.key(layout, width, height, cueIndex, impulse, self.backend))
+                if outcome is None:
+                    remaining.append((cueIndex, impulse))
+                    continue
+                final, pocketed = outcome
+                score = score_shot(layout, final, pocketed, cueIndex, width, height)
+                evaluated += 1
+                cached += 1
+                if best is None or score > best[0]:
+                    best = (score, cueIndex, impulse)
+            shots = remaining
+        batches = [shots[i:i + self.batchSize] for i in range(0, len(shots), self.batchSize)]
+        batches.reverse()
+
+        pool = self.getPool() if batches else None
+        pending = set()
+        while batches or pending:
+            # Keep every worker busy with one batch queued behind it
+            while batches and len(pending) < 2 * self.workers and (
+                    time.monotonic() < deadline or not pending):
+                pending.add(pool.submit(self.evaluate, layout, width, height, batches.pop()))
+            # Always wait for at least one result so there is a shot to take
+            timeout = deadline - time.monotonic() if best is not None else None
+            if timeout is not None and timeout <= 0:
+                break
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    # A worker died, so the next search starts a new pool
+                    pool.shutdown(wait=False)
+                    self.pool = None
+                    raise
+                for score, cueIndex, impulse, final, pocketed in results:
+                    evaluated += 1
+                    if self.cache is not None:
+                        self.cache.put(self.cache.key(layout, width, height, cueIndex, impulse, self.backend),
+                                       (final, pocketed))
+                    if best is None or score > best[0]:
+                        best = (score, cueIndex, impulse)
+        for future in pending:
+            future.cancel()
+        if self.cache is not None:
+            self.cache.flush()
+
+        seconds = time.monotonic() - start
+        if best is None:
+            return ShotResult(None, None, None, evaluated, seconds, cached)
+        return ShotResult(best[0], best[1], best[2], evaluated, seconds, cached)
+
+    # Run plan on a background thread and return a Future for the ShotResult
+    def submit(self, layout, width, height, cueIndices):
+        if self.thread is None:
+            self.thread = ThreadPoolExecutor(max_workers=1)
+        return self.thread.submit(self.plan, layout, width, height, cueIndices)
+
+    # Stop searching without waiting. A search that is still running ends at
+    # its next step, and the cache is closed after it on the planner thread.
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.thread is not None:
+            if self.cache is not None:
+                self.thread.submit(self.cache.close)
+            self.thread.shutdown(wait=False)
+            self.thread = None
+        elif self.cache is not None:
+            self.cache.close()
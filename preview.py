@@ -0,0 +1,241 @@
+import time
+import cv2
+import numpy as np
+from batchphysics import WALL_RADIUS
+from physics import pockets, pocket_radius
+
+# Cushions the aiming line may bounce off before it stops
+MAX_BOUNCES = 2
+# The cue stick is searched for within this many ball radii of the cue ball
+CUE_REACH = 12
+# Largest side in pixels of the image the cue stick is searched in
+CUE_ROI_SIZE = 160
+# The stick's line must pass this many radii from the cue ball's center, and
+# its near end must lie within CUE_TIP radii of it
+CUE_ALIGNMENT = 1.0
+CUE_TIP = 4.0
+# Weight of a new cue direction in the smoothed direction
+CUE_SMOOTHING = 0.5
+# Frames the last cue direction is kept after the stick is lost
+CUE_TIMEOUT = 5
+# Seconds per frame the cue search may take before it runs less often
+PREVIEW_BUDGET = 0.004
+# Run the cue search at most every MAX_STRIDE frames when over budget
+MAX_STRIDE = 4
+# Changes below these reuse the previous path
+PATH_ANGLE = np.radians(0.5)
+PATH_MOVE = 2.0
+PATH_COLOR = (255, 255, 255)
+CONTACT_COLOR = (0, 255, 255)
+
+
+# Find the cue stick pointing at a ball centered on (x, y) with radius r.
+# Returns the unit direction the stick points in, or None.
+def detect_cue(frame, x, y, r, reach=CUE_REACH, size=CUE_ROI_SIZE):
+    half = reach * r
+    h, w = frame.shape[:2]
+    x0, y0 = max(int(x - half), 0), max(int(y - half), 0)
+    x1, y1 = min(int(x + half), w), min(int(y + half), h)
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return None
+    roi = frame[y0:y1, x0:x1]
+    scale = min(1.0, size / max(roi.shape[:2]))
+    if scale < 1:
+        roi = cv2.resize(roi, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # A wooden cue can be as bright as the felt, so edges are found in how far
+    # each pixel's color is from the mostly felt surroundings
+    felt = np.array(cv2.mean(roi)[:3])
+    difference = cv2.absdiff(roi, np.full_like(roi, felt.round().astype(np.uint8))).max(axis=2)
+    edges = cv2.Canny(difference, 50, 150)
+    # The cue ball's own outline is not part of the stick
+    cx, cy, cr = (x - x0) * scale, (y - y0) * scale, r * scale
+    cv2.circle(edges, (int(cx), int(cy)), int(cr * 1.3) + 1, 0, cv2.FILLED)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, max(int(cr * 2), 10),
+                            minLineLength=cr * 3, maxLineGap=max(cr / 2, 2))
+    if lines is None:
+        return None
+
+    best, direction = 0.0, None
+    for ax, ay, bx, by in lines.reshape(-1, 4).astype(np.float64):
+        dx, dy = bx - ax, by - ay
+        length = np.hypot(dx, dy)
+        # Distance from the ball's center to the line through the segment
+        if abs(dx * (cy - ay) - dy * (cx - ax)) / length > CUE_ALIGNMENT * cr:
+            continue
+        near, far = np.hypot(ax - cx, ay - cy), np.hypot(bx - cx, by - cy)
+        if min(near, far) > CUE_TIP * cr or length <= best:
+            continue
+        # The stick points from its far end towards the ball
+        if near < far:
+            dx, dy = -dx, -dy
+        best, direction = length, np.array([dx, dy]) / length
+    return direction
+
+
+# Predicted path of a cue ball rolled from start in a direction: the points it
+# passes through, the first ball it hits and where both balls go afterwards.
+class AimPath:
+    def __init__(self, points, radius, target=None, contact=None, objectDirection=None,
+                 cueDirection=None, pocketed=False):
+        self.points = points
+        self.radius = radius
+        self.target = target
+        self.contact = contact
+        self.objectDirection = objectDirection
+        self.cueDirection = cueDirection
+        self.pocketed = pocketed
+
+
+# Cast the cue ball (x, y, r) along direction through a layout of (x, y, r)
+# balls on a width x height table. The path reflects off the cushions up to
+# maxBounces times and stops at the first ball or pocket it reaches.
+def trace_shot(cue, direction, layout, width, height, maxBounces=MAX_BOUNCES):
+    x, y, r = cue
+    position = np.array([x, y], np.float64)
+    d = np.asarray(direction, np.float64)
+    d = d / np.hypot(*d)
+    layout = np.asarray(layout, np.float64).reshape(-1, 3)
+    centers, reach = layout[:, :2], layout[:, 2] + r
+    low = 1 + WALL_RADIUS + r
+    high = np.array([width, height]) - WALL_RADIUS - r
+    pocketCenters = np.array(pockets(width, height), np.float64)
+    pocketReach = pocket_radius(width, height) + r
+
+    points = [position.copy()]
+    for bounce in range(maxBounces + 1):
+        # Balls: first t where |position + t d - center| = reach
+        tBall, target = first_circle_hit(position, d, centers, reach)
+        tPocket, _ = first_circle_hit(position, d, pocketCenters, pocketReach, inside=True)
+        with np.errstate(divide='ignore'):
+            tWalls = np.where(d > 0, (high - position) / d,
+                              np.where(d < 0, (low - position) / d, np.inf))
+        axis = int(np.argmin(tWalls))
+        tWall = max(float(tWalls[axis]), 0.0)
+
+        t = min(tBall, tPocket, tWall)
+        if not np.isfinite(t):
+            break
+        position = position + t * d
+        points.append(position.copy())
+        if t == tBall:
+            # The object ball leaves along the line of centers, the cue ball
+            # along the tangent
+            normal = centers[target] - position
+            normal /= np.hypot(*normal)
+            cueDirection = d - np.dot(d, normal) * normal
+            return AimPath(points, r, target, position, normal, cueDirection)
+        if t == tPocket:
+            return AimPath(points, r, pocketed=True)
+        d = d.copy()
+        d[axis] = -d[axis]
+    return AimPath(points, r)
+
+
+# Distance along a ray to the first of several circles it enters, and which.
+# With inside, a ray starting inside a circle hits it straight away.
+def first_circle_hit(position, d, centers, radii, inside=False):
+    if len(centers) == 0:
+        return np.inf, None
+    f = centers - position
+    b = f @ d
+    c = (f * f).sum(axis=1) - radii ** 2
+    disc = b * b - c
+    t = b - np.sqrt(np.maximum(disc, 0))
+    # Circles behind the ray, missed by it or already overlapping are skipped
+    hit = (disc >= 0) & (t > 1e-6) & (c > 0)
+    if inside:
+        hit |= c <= 0
+        t = np.where(c <= 0, 0.0, t)
+    if not hit.any():
+        return np.inf, None
+    t = np.where(hit, t, np.inf)
+    k = int(np.argmin(t))
+    return float(t[k]), k
+
+
+# Draw the cue ball's path, and at the first contact a ghost cue ball with
+# the directions both balls leave in
+def draw_path(frame, path):
+    radius = path.radius
+    points = np.round(np.array(path.points)).astype(np.int32)
+    cv2.polylines(frame, [points], False, PATH_COLOR, 1, cv2.LINE_AA)
+    if path.contact is None:
+        return
+    contact = tuple(int(v) for v in np.round(path.contact))
+    # Ghost ball where the cue ball touches the object ball
+    cv2.circle(frame, contact, int(radius), PATH_COLOR, 1, cv2.LINE_AA)
+    length = 4 * radius
+    target = path.contact + path.objectDirection * (2 * radius)
+    end = tuple(int(v) for v in np.round(target + path.objectDirection * length))
+    cv2.arrowedLine(frame, tuple(int(v) for v in np.round(target)), end, CONTACT_COLOR, 2,
+                    cv2.LINE_AA, tipLength=0.25)
+    end = tuple(int(v) for v in np.round(path.contact + path.cueDirection * length))
+    cv2.line(frame, contact, end, PATH_COLOR, 1, cv2.LINE_AA)
+
+
+# Live aiming preview for the player's turn. The cue stick is found near the
+# cue ball each frame and the cue ball's path is traced from it with ray
+# queries against the balls and cushions. The path is reused while the cue
+# and balls stay put, and the cue search runs less often when it goes over
+# its time budget.
+class ShotPreview:
+    def __init__(self, cueLabel, maxBounces=MAX_BOUNCES, budget=PREVIEW_BUDGET):
+        self.cueLabel = cueLabel
+        self.maxBounces = maxBounces
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.direction = None
+        self.missed = 0
+        self.stride = 1
+        self.frames = 0
+        self.path = None
+        self.key = None
+
+    # Update from a clean frame and the tracked balls. Returns the AimPath, or None.
+    def update(self, frame, tracks, width, height):
+        cue = next((t for t in tracks if t.label == self.cueLabel and not t.stripe), None)
+        if cue is None:
+            self.direction = None
+            return None
+
+        self.frames += 1
+        if self.frames % self.stride == 0:
+            start = time.perf_counter()
+            found = detect_cue(frame, cue.x, cue.y, cue.r)
+            elapsed = time.perf_counter() - start
+            if elapsed > self.budget:
+                self.stride = min(self.stride + 1, MAX_STRIDE)
+            elif elapsed < self.budget / 2 and self.stride > 1:
+                self.stride -= 1
+            if found is None:
+                self.missed += 1
+                if self.missed > CUE_TIMEOUT:
+                    self.direction = None
+            else:
+                self.missed = 0
+                if self.direction is not None and np.dot(found, self.direction) > 0:
+                    found = (1 - CUE_SMOOTHING) * self.direction + CUE_SMOOTHING * found
+                    found /= np.hypot(*found)
+                self.direction = found
+        if self.direction is None:
+            return None
+
+        others = [(t.x, t.y, t.r) for t in tracks if t is not cue]
+        key = (np.array([cue.x, cue.y] + [v for ball in others for v in ball[:2]]),
+               np.arctan2(self.direction[1], self.direction[0]))
+        if self.path is None or not self.same(key):
+            self.path = trace_shot((cue.x, cue.y, cue.r), self.direction, others,
+                                   width, height, self.maxBounces)
+            self.key = key
+        return self.path
+
+    # Whether the cue angle and ball positions are close to those of the last path
+    def same(self, key):
+        positions, angle = key
+        lastPositions, lastAngle = self.key
+        if positions.shape != lastPositions.shape:
+            return False
+        turn = abs((angle - lastAngle + np.pi) % (2 * np.pi) - np.pi)
+        return turn < PATH_ANGLE and np.abs(positions - lastPositions).max() < PATH_MOVE
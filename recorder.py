@@ -0,0 +1,176 @@
+import json
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+# Frames waiting to be written before new ones are dropped
+QUEUE_SIZE = 64
+RECORD_FPS = 30
+# Motion JPEG keeps every frame intact enough to replay detection
+FOURCC = 'MJPG'
+SIDECAR_EXTENSION = '.jsonl'
+
+
+# Video file of a segment of a recording. The first segment keeps the
+# recording's name, later ones are numbered: game.avi, game-1.avi, ...
+def segment_filename(filename, index):
+    if index == 0:
+        return filename
+    base, extension = os.path.splitext(filename)
+    return "{}-{}{}".format(base, index, extension)
+
+
+# Sidecar file written next to a recording
+def sidecar_filename(filename):
+    return os.path.splitext(filename)[0] + SIDECAR_EXTENSION
+
+
+# Read the per-frame records of a recording, in frame order
+def load_sidecar(filename):
+    records = []
+    with open(sidecar_filename(filename)) as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                if 'recording' not in record:
+                    records.append(record)
+    return records
+
+
+# The header of a recording's sidecar, or None if the source is not a recording
+def recording_info(filename):
+    if not isinstance(filename, str) or not os.path.isfile(sidecar_filename(filename)):
+        return None
+    with open(sidecar_filename(filename)) as file:
+        record = json.loads(file.readline() or '{}')
+    return record.get('recording')
+
+
+# Whether a source is a recording of already rectified table frames, which
+# must not be calibrated again when it is replayed
+def is_rectified(filename):
+    info = recording_info(filename)
+    return bool(info and info.get('rectified'))
+
+
+# Records a session to a compressed video and a JSON lines sidecar with one
+# record per frame: its capture time, detections, turn and physics positions.
+# The first line of the sidecar describes the recording: whether the frames
+# were rectified with a table calibration, and which one.
+# A video holds frames of one size and calibration, so when either changes
+# mid-session, for example when the table is calibrated, the recording rolls
+# over to a new segment (see segment_filename) with its own sidecar and header.
+# Frames that cannot be written to a video at all are dropped.
+# The video plays at a nominal fps, but frames are recorded as the game loop
+# shows them, so the time of each frame in the sidecar is what counts.
+# Everything is written on a background thread. When the writer falls behind,
+# new frames are dropped instead of blocking the caller.
+# The video replays through sources.open_source like any other recording.
+class SessionRecorder:
+    def __init__(self, filename, fps=RECORD_FPS, queueSize=QUEUE_SIZE, fourcc=FOURCC):
+        self.filename = filename
+        self.fps = fps if fps and fps > 0 else RECORD_FPS
+        self.fourcc = fourcc
+        self.queue = queue.Queue(maxsize=max(queueSize, 1))
+        self.written = 0
+        self.dropped = 0
+        self.segments = []
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    # Queue a frame with its metadata. The frame is kept as is, so pass a copy
+    # if it will be drawn on. detections and positions must be plain JSON data.
+    # calibration is the TableCalibration the frame was rectified with, if any.
+    # Returns False if the frame was dropped.
+    def record(self, frame, time, detections=None, turn=None, positions=None,
+               calibration=None):
+        if self.error is not None:
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait((frame, time, detections, turn, positions, calibration))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def run(self):
+        writer = None
+        sidecar = None
+        segment = None
+        frames = 0
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                frame, time, detections, turn, positions, calibration = item
+                # OpenCV silently skips frames that do not match the video
+                if frame is None or frame.dtype != np.uint8 or frame.ndim != 3 or frame.shape[2] != 3:
+                    self.dropped += 1
+                    continue
+                calibrationData = calibration.toDict() if calibration is not None else None
+                if segment != (frame.shape, calibrationData):
+                    if writer is not None:
+                        writer.release()
+                        sidecar.close()
+                        writer = sidecar = None
+                    segment = (frame.shape, calibrationData)
+                    filename = segment_filename(self.filename, len(self.segments))
+                    h, w = frame.shape[:2]
+                    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*self.fourcc),
+                                             self.fps, (w, h))
+                    if not writer.isOpened():
+                        raise IOError("Could not open video writer: {}".format(filename))
+                    self.segments.append(filename)
+                    frames = 0
+                    sidecar = open(sidecar_filename(filename), "w")
+                    sidecar.write(json.dumps({'recording': {
+                        'fps': self.fps,
+                        'segment': len(self.segments) - 1,
+                        'rectified': calibration is not None,
+                        'calibration': calibrationData
+                    }}) + "\n")
+                writer.write(frame)
+                sidecar.write(json.dumps({
+                    'frame': frames,
+                    'time': time,
+                    'turn': turn,
+                    'detections': detections,
+                    'positions': positions
+                }) + "\n")
+                frames += 1
+                self.written += 1
+        except Exception as error:
+            self.error = error
+            print("Error: Recording stopped:", error)
+        finally:
+            if writer is not None:
+                writer.release()
+            if sidecar is not None:
+                sidecar.close()
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'segments': len(self.segments)}
+
+    def report(self):
+        return "Recording: {written} frames written in {segments} segments, {dropped} dropped".format(
+            **self.stats())
+
+    # Write the queued frames and close the files
+    def close(self):
+        if self.thread is None:
+            return
+        if self.error is None:
+            self.queue.put(None)
+        self.thread.join()
+        self.thread = None
@@ -0,0 +1,96 @@
+import time
+from collections import deque
+import numpy as np
+
+TARGET_FPS = 30
+# Shortest wait between ticks in seconds, so Tk always gets to handle clicks
+# and slider drags even when a tick takes longer than a frame
+MIN_DELAY = 0.002
+# Ticks kept for the achieved fps and jitter
+WINDOW = 300
+
+
+# Runs the frame loop of the visible page at a target frame rate on the Tk
+# event loop. Each tick is scheduled for the next frame deadline after
+# subtracting how long the last tick took. Frames missed while a tick ran
+# long are skipped rather than run back to back. Only one loop runs at a time:
+# starting a page's loop stops the previous one.
+class FrameScheduler:
+    def __init__(self, fps=TARGET_FPS, minDelay=MIN_DELAY, window=WINDOW):
+        self.minDelay = minDelay
+        self.setFps(fps)
+        self.widget = None
+        self.callback = None
+        self.job = None
+        self.deadline = 0.0
+        self.lastStart = None
+        self.intervals = deque(maxlen=window)
+        self.work = deque(maxlen=window)
+        self.ticks = 0
+        self.skipped = 0
+
+    def setFps(self, fps):
+        self.fps = fps if fps and fps > 0 else TARGET_FPS
+        self.period = 1 / self.fps
+
+    # Run callback once per frame with widget's after() until stopped
+    def start(self, widget, callback):
+        self.stop()
+        self.widget = widget
+        self.callback = callback
+        self.lastStart = None
+        self.deadline = time.monotonic()
+        self.tick()
+
+    # Stop the running loop, or only the loop of callback if given
+    def stop(self, callback=None):
+        if callback is not None and callback != self.callback:
+            return
+        if self.job is not None:
+            self.widget.after_cancel(self.job)
+            self.job = None
+        self.callback = None
+
+    def tick(self):
+        self.job = None
+        start = time.monotonic()
+        if self.lastStart is not None:
+            self.intervals.append(start - self.lastStart)
+        self.lastStart = start
+        callback = self.callback
+        callback()
+        end = time.monotonic()
+        self.work.append(end - start)
+        self.ticks += 1
+        # The callback may have stopped the loop or started another one
+        if self.callback is not callback or self.job is not None:
+            return
+
+        self.deadline += self.period
+        if self.deadline < end:
+            # Behind schedule: drop the missed frames and restart the cadence now
+            self.skipped += int((end - self.deadline) / self.period) + 1
+            self.deadline = end
+        delay = max(self.minDelay, self.deadline - end)
+        self.job = self.widget.after(max(1, int(round(delay * 1000))), self.tick)
+
+    # Achieved fps, jitter (standard deviation of the tick interval) and tick
+    # work time in milliseconds over the last ticks
+    def stats(self):
+        intervals = np.array(self.intervals) * 1000
+        work = np.array(self.work) * 1000
+        mean = float(intervals.mean()) if len(intervals) else 0.0
+        return {
+            'target_fps': self.fps,
+            'fps': 1000 / mean if mean > 0 else 0.0,
+            'jitter_ms': float(intervals.std()) if len(intervals) else 0.0,
+            'p95_interval_ms': float(np.percentile(intervals, 95)) if len(intervals) else 0.0,
+            'work_ms': float(work.mean()) if len(work) else 0.0,
+            'ticks': self.ticks,
+            'skipped': self.skipped
+        }
+
+    def report(self):
+        return ("Frame loop: {fps:.1f} of {target_fps:g} fps, jitter {jitter_ms:.1f} ms, "
+                "p95 interval {p95_interval_ms:.1f} ms, work {work_ms:.1f} ms, "
+                "{skipped} frames skipped over {ticks} ticks").format(**self.stats())
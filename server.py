@@ -0,0 +1,308 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import resource_tracker, shared_memory
+import cv2
+import numpy as np
+from core import PoolCore, load_balls, DATA_FILE
+from detection import DETECTION_SCALE, MIN_RADIUS, cue_index
+from physics import build_world, resolve_shot
+from sources import REPLAY_MODES, NATIVE
+
+# Frame slots per table in shared memory
+FRAME_SLOTS = 4
+# Bytes before the frames holding the frame index of every slot
+HEADER_SIZE = 64
+# Seconds a worker sleeps when there is no new frame
+IDLE_SLEEP = 0.002
+# Seconds to wait for a worker to open its source
+START_TIMEOUT = 30
+
+
+# Ring of frames in shared memory written by a table worker and read by the
+# coordinator without pickling. Each slot carries the index of the frame in it,
+# set to -1 while the slot is being written, so a reader can tell when a slot
+# was overwritten under it.
+class SharedFrames:
+    def __init__(self, shm, shape, slots, owner):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.owner = owner
+        self.header = np.ndarray((slots,), np.int64, buffer=shm.buf)
+        self.frames = np.ndarray((slots,) + self.shape, np.uint8, buffer=shm.buf,
+                                 offset=HEADER_SIZE)
+
+    @staticmethod
+    def create(shape, slots=FRAME_SLOTS):
+        size = HEADER_SIZE + slots * int(np.prod(shape))
+        frames = SharedFrames(shared_memory.SharedMemory(create=True, size=size),
+                              shape, slots, True)
+        frames.header[:] = -1
+        return frames
+
+    @staticmethod
+    def attach(name, shape, slots=FRAME_SLOTS):
+        shm = shared_memory.SharedMemory(name=name)
+        # Attaching registers the block with this process's resource tracker
+        # as if it were ours. Only the creating worker unlinks it.
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return SharedFrames(shm, shape, slots, False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # Copy a frame into its slot and return the slot
+    def write(self, frame, index):
+        slot = index % self.slots
+        self.header[slot] = -1
+        self.frames[slot] = frame
+        self.header[slot] = index
+        return slot
+
+    # Copy of the frame with this index, or None if it has been overwritten
+    def read(self, slot, index):
+        if self.header[slot] != index:
+            return None
+        frame = self.frames[slot].copy()
+        if self.header[slot] != index:
+            return None
+        return frame
+
+    def close(self):
+        # Views must be released before the mapping can close
+        self.header = None
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Capture, detection and physics of one table, run in its own process.
+# Frames go to shared memory, and only the tracked balls and shot outcomes are
+# sent back on the results queue.
+def table_worker(table, source, replay, ballObjects, white, scale, calibrationFile,
+                 results, commands):
+    core = PoolCore(ballObjects, scale, white, MIN_RADIUS)
+    frames = None
+    try:
+        cap = core.open(source, replay, calibrationFile).capture()
+        frame, _, index = cap.latest()
+        while frame is None:
+            time.sleep(IDLE_SLEEP)
+            frame, _, index = cap.latest()
+        frames = SharedFrames.create(frame.shape)
+        results.put(('ready', table, frames.name, frame.shape))
+
+        tracks = []
+        lastIndex = -1
+        while True:
+            try:
+                command = commands.get_nowait()
+            except queue.Empty:
+                command = None
+            if command is not None:
+                if command[0] == 'stop':
+                    break
+                if command[0] == 'shot':
+                    results.put(('shot', table) + resolve_table_shot(core, tracks, *command[1:]))
+
+            frame, captureTime, index = cap.latest()
+            if frame is None or index == lastIndex:
+                time.sleep(IDLE_SLEEP)
+                continue
+            lastIndex = index
+            tracks = [track for track in core.tracker.detect(frame) if track.r > MIN_RADIUS]
+            slot = frames.write(frame, index)
+            results.put(('frame', table, index, slot, captureTime,
+                         [(t.id, t.label, t.stripe, float(t.x), float(t.y), float(t.r))
+                          for t in tracks]))
+    except Exception as error:
+        results.put(('error', table, repr(error)))
+    finally:
+        core.release()
+        if frames is not None:
+            frames.close()
+        results.put(('stopped', table))
+
+
+# Resolve a shot on the detected layout of a table in a fresh physics world.
+# Returns (ball ids, final positions, pocketed steps).
+def resolve_table_shot(core, tracks, ballId, impulse):
+    ids = [track.id for track in tracks]
+    if ballId not in ids:
+        return ids, [], []
+    space, bodies = build_world([(t.x, t.y, t.r) for t in tracks], core.width, core.height)
+    body = bodies[ids.index(ballId)]
+    body.apply_impulse_at_world_point(impulse, body.position)
+    trajectory = resolve_shot(space, bodies)
+    return ids, trajectory.finalPositions().tolist(), trajectory.pocketed
+
+
+# Latest state of a table as seen by the coordinator
+class TableState:
+    def __init__(self, table, source):
+        self.table = table
+        self.source = source
+        self.frames = None
+        self.index = -1
+        self.slot = -1
+        self.captureTime = 0.0
+        self.balls = []
+        self.received = 0
+        self.firstTime = None
+        self.lastTime = None
+        self.shot = None
+        self.error = None
+        self.stopped = False
+
+    def fps(self):
+        if self.received < 2 or self.lastTime <= self.firstTime:
+            return 0.0
+        return (self.received - 1) / (self.lastTime - self.firstTime)
+
+
+# Drives several tables from one machine, one worker process per table.
+# calibrationFiles holds a table calibration file (or None) per table.
+class TableServer:
+    def __init__(self, sources, ballObjects, replay=NATIVE, scale=DETECTION_SCALE,
+                 calibrationFiles=None):
+        self.sources = list(sources)
+        self.ballObjects = ballObjects
+        self.replay = replay
+        self.scale = scale
+        self.calibrationFiles = calibrationFiles or [None] * len(self.sources)
+        self.white = cue_index([b.name for b in ballObjects])
+        self.tables = [TableState(i, source) for i, source in enumerate(self.sources)]
+        self.results = None
+        self.commands = []
+        self.processes = []
+
+    def start(self, timeout=START_TIMEOUT):
+        self.results = multiprocessing.Queue()
+        for table in self.tables:
+            commands = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=table_worker, daemon=True,
+                args=(table.table, table.source, self.replay, self.ballObjects, self.white,
+                      self.scale, self.calibrationFiles[table.table], self.results, commands))
+            process.start()
+            self.commands.append(commands)
+            self.processes.append(process)
+        deadline = time.monotonic() + timeout
+        while any(t.frames is None and t.error is None for t in self.tables):
+            if time.monotonic() > deadline:
+                raise RuntimeError("Tables did not start in {} s".format(timeout))
+            self.poll(0.1)
+        return self
+
+    # Handle the messages from the workers, waiting up to timeout for the first
+    def poll(self, timeout=0.0):
+        handled = 0
+        while True:
+            try:
+                if handled == 0 and timeout:
+                    message = self.results.get(timeout=timeout)
+                else:
+                    message = self.results.get_nowait()
+            except queue.Empty:
+                return handled
+            handled += 1
+            kind, table = message[0], self.tables[message[1]]
+            if kind == 'frame':
+                _, _, table.index, table.slot, table.captureTime, table.balls = message
+                now = time.monotonic()
+                if table.firstTime is None:
+                    table.firstTime = now
+                table.lastTime = now
+                table.received += 1
+            elif kind == 'ready':
+                table.frames = SharedFrames.attach(message[2], message[3])
+            elif kind == 'shot':
+                table.shot = message[2:]
+            elif kind == 'error':
+                table.error = message[2]
+            elif kind == 'stopped':
+                table.stopped = True
+
+    # Copy of the latest frame of a table, or None
+    def frame(self, table):
+        state = self.tables[table]
+        if state.frames is None or state.slot < 0:
+            return None
+        return state.frames.read(state.slot, state.index)
+
+    # Ask a table to resolve hitting one of its tracked balls with an impulse.
+    # The outcome arrives in its TableState.shot.
+    def shot(self, table, ballId, impulse):
+        self.tables[table].shot = None
+        self.commands[table].put(('shot', ballId, impulse))
+
+    def stop(self):
+        for commands in self.commands:
+            commands.put(('stop',))
+        deadline = time.monotonic() + 5
+        while not all(t.stopped for t in self.tables) and time.monotonic() < deadline:
+            self.poll(0.1)
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        for table in self.tables:
+            if table.frames is not None:
+                table.frames.close()
+                table.frames = None
+
+
+# Run several tables from recordings or cameras and report their frame rates
+def main():
+    parser = argparse.ArgumentParser(description="Pool IRL multi-table server")
+    parser.add_argument('sources', nargs='+',
+                        help="one camera port, video file or image directory per table")
+    parser.add_argument('--data', default=DATA_FILE, help="ball HSV settings file")
+    parser.add_argument('--replay', choices=REPLAY_MODES, default=NATIVE)
+    parser.add_argument('--scale', type=float, default=DETECTION_SCALE,
+                        help="detection scale, 1 searches at full resolution")
+    parser.add_argument('--seconds', type=float, default=10,
+                        help="run for this long, 0 runs until interrupted")
+    parser.add_argument('--calibration', action='append', default=[],
+                        help="table calibration file, given once per table in source order")
+    parser.add_argument('--show', action='store_true', help="show every table's video")
+    args = parser.parse_args()
+
+    calibrationFiles = args.calibration + [None] * (len(args.sources) - len(args.calibration))
+    server = TableServer(args.sources, load_balls(args.data), args.replay, args.scale,
+                         calibrationFiles).start()
+    start = time.monotonic()
+    try:
+        while not args.seconds or time.monotonic() - start < args.seconds:
+            server.poll(0.05)
+            if args.show:
+                for table in server.tables:
+                    frame = server.frame(table.table)
+                    if frame is None:
+                        continue
+                    for _, _, _, x, y, r in table.balls:
+                        cv2.circle(frame, (int(x), int(y)), int(r), (0, 255, 0), 2)
+                    cv2.imshow("Table {}".format(table.table), frame)
+                cv2.waitKey(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+    print("{:>5} {:>8} {:>8} {:>6}  {}".format("table", "frames", "fps", "balls", "source"))
+    for table in server.tables:
+        print("{:>5} {:>8} {:>8.1f} {:>6}  {}".format(
+            table.table, table.received, table.fps(), len(table.balls), table.source))
+        if table.error:
+            print("      error:", table.error)
+    print("total {:.1f} fps".format(sum(table.fps() for table in server.tables)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Outcomes kept in memory
+CACHE_SIZE = 50000
+# Outcomes kept in the file, the oldest written are deleted beyond this
+DB_SIZE = 200000
+# Grid in pixels that ball positions and radii are snapped to
+POSITION_QUANTUM = 2.0
+# Grid that impulse components are snapped to
+IMPULSE_QUANTUM = 10.0
+
+
+def quantize(value, quantum):
+    return round(value / quantum) * quantum
+
+
+# Memoized shot outcomes keyed on the quantized layout, table size, cue ball
+# and impulse, with LRU eviction in memory and an optional SQLite file that
+# keeps the most recently written outcomes across restarts. Shots must be simulated on the quantized
+# layout so every outcome is exactly what its key describes.
+class ShotCache:
+    def __init__(self, size=CACHE_SIZE, filename=None, positionQuantum=POSITION_QUANTUM,
+                 impulseQuantum=IMPULSE_QUANTUM, dbSize=DB_SIZE):
+        self.size = max(size, 1)
+        self.dbSize = max(dbSize, 1)
+        self.filename = filename
+        self.positionQuantum = positionQuantum
+        self.impulseQuantum = impulseQuantum
+        self.entries = OrderedDict()
+        self.pending = []
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Layout of (x, y, r) balls snapped to the position grid
+    def quantizeLayout(self, layout):
+        q = self.positionQuantum
+        return [(quantize(x, q), quantize(y, q), quantize(r, q)) for x, y, r in layout]
+
+    # variant separates outcomes of different simulations, e.g. physics backends
+    def key(self, layout, width, height, cueIndex, impulse, variant=''):
+        q = self.positionQuantum
+        parts = (variant, int(round(width)), int(round(height)), cueIndex,
+                 tuple(int(round(value / self.impulseQuantum)) for value in impulse),
+                 tuple(tuple(int(round(value / q)) for value in ball) for ball in layout))
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def getDb(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS shots (key TEXT PRIMARY KEY, outcome BLOB)")
+        return self.db
+
+    def remember(self, key, outcome):
+        self.entries[key] = outcome
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    # Cached outcome of a shot, or None
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.filename is not None:
+                row = self.getDb().execute(
+                    "SELECT outcome FROM shots WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    outcome = pickle.loads(row[0])
+                    self.remember(key, outcome)
+                    self.hits += 1
+                    return outcome
+            self.misses += 1
+            return None
+
+    def put(self, key, outcome):
+        with self.lock:
+            self.remember(key, outcome)
+            if self.filename is not None:
+                self.pending.append((key, pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)))
+
+    # Write new outcomes to the file in one transaction, deleting the oldest
+    # beyond dbSize. Rows get increasing rowids as they are written.
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            db = self.getDb()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO shots VALUES (?, ?)", self.pending)
+                db.execute("DELETE FROM shots WHERE rowid <= (SELECT MAX(rowid) FROM shots) - ?",
+                           (self.dbSize,))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
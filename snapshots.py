@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+# Number of full resolution overlays kept decoded in memory
+CACHE_SIZE = 4
+THUMBNAIL_WIDTH = 150
+IMAGE_FORMAT = '.jpg'
+IMAGE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 90]
+
+
+# A saved practice frame: the image lives on disk, only the thumbnail in memory
+class Snapshot:
+    def __init__(self, id, time, filename, shape, thumbnail, written):
+        self.id = id
+        self.time = time
+        self.filename = filename
+        self.shape = shape
+        self.thumbnail = thumbnail
+        self.written = written
+
+
+# Stores practice snapshots compressed on disk with a small LRU cache of
+# decoded BGR overlays. Files are written on a background thread.
+class SnapshotStore:
+    def __init__(self, directory=None, cacheSize=CACHE_SIZE,
+                 imageFormat=IMAGE_FORMAT, imageParams=IMAGE_PARAMS):
+        self.directory = directory
+        self.ownsDirectory = directory is None
+        self.cacheSize = max(cacheSize, 1)
+        self.imageFormat = imageFormat
+        self.imageParams = imageParams
+        self.snapshots = []
+        self.cache = OrderedDict()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __getitem__(self, id):
+        return self.snapshots[id]
+
+    def getDirectory(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='pirl-snapshots-')
+        os.makedirs(self.directory, exist_ok=True)
+        return self.directory
+
+    # Save a BGR frame and return its Snapshot
+    def add(self, frame, time):
+        # The caller may draw on its frame while it is being written
+        frame = frame.copy()
+        id = len(self.snapshots)
+        filename = os.path.join(self.getDirectory(),
+                                "snapshot_{:05d}{}".format(id, self.imageFormat))
+        (h, w) = frame.shape[:2]
+        r = THUMBNAIL_WIDTH / float(w)
+        thumbnail = cv2.cvtColor(cv2.resize(frame, (THUMBNAIL_WIDTH, int(h * r)),
+                                            interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+        written = self.writer.submit(cv2.imwrite, filename, frame, self.imageParams)
+        snapshot = Snapshot(id, time, filename, frame.shape, thumbnail, written)
+        self.snapshots.append(snapshot)
+        self.cacheOverlay(id, frame)
+        return snapshot
+
+    def cacheOverlay(self, id, overlay):
+        self.cache[id] = overlay
+        self.cache.move_to_end(id)
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+
+    # Full resolution BGR overlay of a snapshot, decoded from disk on a cache miss
+    def overlay(self, id):
+        if id in self.cache:
+            self.cache.move_to_end(id)
+            return self.cache[id]
+        snapshot = self.snapshots[id]
+        snapshot.written.result()
+        overlay = cv2.imread(snapshot.filename)
+        if overlay is not None:
+            self.cacheOverlay(id, overlay)
+        return overlay
+
+    # Delete every snapshot
+    def clear(self):
+        for snapshot in self.snapshots:
+            snapshot.written.result()
+            if os.path.exists(snapshot.filename):
+                os.remove(snapshot.filename)
+        self.snapshots = []
+        self.cache.clear()
+
+    def close(self):
+        self.clear()
+        self.writer.shutdown()
+        if self.ownsDirectory and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
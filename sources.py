@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import cv2
+
+# Replay modes for recorded sources
+NATIVE = 'native'      # Play every frame at the source frame rate
+REALTIME = 'realtime'  # Follow the wall clock and skip frames when behind, like a live camera
+FAST = 'fast'          # Play every frame as fast as it is read
+REPLAY_MODES = (NATIVE, REALTIME, FAST)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+DEFAULT_FPS = 30
+
+
+# Open a live camera, using DirectShow on Windows like the original app
+def open_camera(port):
+    if sys.platform == 'win32':
+        return cv2.VideoCapture(port, cv2.CAP_DSHOW)
+    return cv2.VideoCapture(port)
+
+
+# Open a frame source from a camera port, a video file or a directory of images.
+# Every source has the cv2.VideoCapture read/get/release interface.
+def open_source(spec, mode=NATIVE, loop=True, fps=None):
+    if isinstance(spec, int) or str(spec).isdigit():
+        return open_camera(int(spec))
+    if os.path.isdir(spec):
+        return ImageSequenceSource(spec, mode, loop, fps or DEFAULT_FPS)
+    if os.path.isfile(spec):
+        return VideoFileSource(spec, mode, loop, fps)
+    raise ValueError("Unknown frame source: {}".format(spec))
+
+
+# Base class for recorded sources that paces reads according to the replay mode
+class ReplaySource:
+    def __init__(self, mode, loop, fps):
+        if mode not in REPLAY_MODES:
+            raise ValueError("Unknown replay mode: {}".format(mode))
+        self.mode = mode
+        self.loop = loop
+        self.fps = fps if fps and fps > 0 else DEFAULT_FPS
+        self.nextIndex = 0
+        self.startTime = None
+        self.width = 0
+        self.height = 0
+
+    def frameCount(self):
+        raise NotImplementedError
+
+    def readFrame(self, index, image):
+        raise NotImplementedError
+
+    # Make the next read return frame index, with the replay clock moved to match
+    def seek(self, index):
+        self.nextIndex = index
+        self.startTime = time.monotonic() - index / self.fps
+
+    def read(self, image=None):
+        now = time.monotonic()
+        if self.startTime is None:
+            self.startTime = now
+        index = self.nextIndex
+        if self.mode == REALTIME:
+            # Skip the frames that are already due when behind
+            index = max(index, int((now - self.startTime) * self.fps))
+        if self.mode in (NATIVE, REALTIME):
+            # Wait for the frame's time when ahead
+            delay = self.startTime + index / self.fps - now
+            if delay > 0:
+                time.sleep(delay)
+
+        count = self.frameCount()
+        if count and index >= count:
+            if not self.loop:
+                return False, None
+            self.startTime = time.monotonic()
+            index = 0
+
+        ret, frame = self.readFrame(index, image)
+        if not ret and self.loop and index > 0:
+            # Frame counts reported by some containers are approximate
+            self.startTime = time.monotonic()
+            index = 0
+            ret, frame = self.readFrame(index, image)
+        self.nextIndex = index + 1
+        return ret, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.frameCount()
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.nextIndex
+        return 0
+
+    def isOpened(self):
+        return self.width > 0
+
+    def release(self):
+        pass
+
+
+# Replays a video file
+class VideoFileSource(ReplaySource):
+    def __init__(self, filename, mode=NATIVE, loop=True, fps=None):
+        self.video = cv2.VideoCapture(filename)
+        if not self.video.isOpened():
+            raise ValueError("Could not open video: {}".format(filename))
+        ReplaySource.__init__(self, mode, loop, fps or self.video.get(cv2.CAP_PROP_FPS))
+        self.width = self.video.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.position = 0
+
+    def frameCount(self):
+        return self.count
+
+    def readFrame(self, index, image):
+        if index < self.position:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+        # Skip frames without decoding them
+        while self.position < index:
+            if not self.video.grab():
+                return False, None
+            self.position += 1
+        ret, frame = self.video.read(image)
+        if ret:
+            self.position += 1
+        return ret, frame
+
+    def seek(self, index):
+        ReplaySource.seek(self, index)
+        if index != self.position:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+
+    def release(self):
+        self.video.release()
+
+
+# Replays a directory of images in file name order
+class ImageSequenceSource(ReplaySource):
+    def __init__(self, directory, mode=NATIVE, loop=True, fps=DEFAULT_FPS):
+        ReplaySource.__init__(self, mode, loop, fps)
+        self.files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.files:
+            raise ValueError("No images found in: {}".format(directory))
+        first = cv2.imread(self.files[0])
+        if first is None:
+            raise ValueError("Could not read image: {}".format(self.files[0]))
+        self.height, self.width = first.shape[:2]
+
+    def frameCount(self):
+        return len(self.files)
+
+    def readFrame(self, index, image):
+        frame = cv2.imread(self.files[index])
+        return frame is not None, frame
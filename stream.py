@@ -0,0 +1,159 @@
+import select
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+
+STREAM_HOST = '0.0.0.0'
+STREAM_PORT = 8080
+JPEG_QUALITY = 80
+BOUNDARY = 'frame'
+# Seconds a client waits for a new frame before checking the server is still up
+CLIENT_TIMEOUT = 1.0
+PAGE = """<html><head><title>Pool IRL</title></head>
+<body style="margin:0;background:#000"><img src="/stream" style="width:100%"></body></html>
+"""
+
+
+# Serves the composited table view as MJPEG over HTTP. Frames are encoded once
+# on a background thread and the same bytes go to every client. Each client
+# always gets the newest frame, so a slow viewer skips frames instead of
+# holding up the table or the other viewers.
+class MjpegStreamer:
+    def __init__(self, host=STREAM_HOST, port=STREAM_PORT, quality=JPEG_QUALITY):
+        self.host = host
+        self.port = port
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.condition = threading.Condition()
+        self.pending = None
+        self.jpeg = None
+        self.sequence = 0
+        self.clients = 0
+        self.encoded = 0
+        self.running = False
+        self.server = None
+        self.threads = []
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        # A handler class per server, bound to this streamer
+        Handler = type('Handler', (StreamHandler,), {'streamer': self})
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.threads = [threading.Thread(target=self.server.serve_forever, daemon=True),
+                        threading.Thread(target=self.encode, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    # Hand a BGR frame to the encoder. The frame must not be changed afterwards;
+    # nothing is copied or encoded while no one is watching.
+    def publish(self, frame):
+        if not self.running or self.clients == 0:
+            return
+        with self.condition:
+            self.pending = frame
+            self.condition.notify_all()
+
+    def encode(self):
+        while self.running:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                frame = self.pending
+                self.pending = None
+            if frame is None:
+                continue
+            ok, jpeg = cv2.imencode('.jpg', frame, self.params)
+            if not ok:
+                continue
+            with self.condition:
+                self.jpeg = jpeg.tobytes()
+                self.sequence += 1
+                self.encoded += 1
+                self.condition.notify_all()
+
+    # Newest encoded frame after `sequence`, as (sequence, bytes), or None on timeout
+    def next(self, sequence, timeout=CLIENT_TIMEOUT):
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: not self.running or self.sequence > sequence, timeout):
+                return None
+            if not self.running:
+                return None
+            return self.sequence, self.jpeg
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.threads:
+            thread.join(1)
+        self.threads = []
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    streamer = None
+
+    def do_GET(self):
+        if self.path == '/':
+            body = PAGE.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/stream':
+            self.stream()
+        else:
+            self.send_error(404)
+
+    def stream(self):
+        streamer = self.streamer
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + BOUNDARY)
+        self.end_headers()
+        with streamer.condition:
+            streamer.clients += 1
+        sequence = 0
+        try:
+            while streamer.running:
+                frame = streamer.next(sequence)
+                if frame is None:
+                    # Without new frames nothing is written, so a viewer
+                    # that left would never be noticed
+                    if self.closed():
+                        break
+                    continue
+                sequence, jpeg = frame
+                self.wfile.write("--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n".format(
+                    BOUNDARY, len(jpeg)).encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with streamer.condition:
+                streamer.clients -= 1
+
+    # Whether the client has closed its end of the connection
+    def closed(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    # Keep request logging off the console
+    def log_message(self, format, *args):
+        pass
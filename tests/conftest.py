@@ -0,0 +1,33 @@
+import os
+import sys
+from types import SimpleNamespace
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def ball_objects():
+    return [SimpleNamespace(name='Yellow', hMin=20, hMax=35, sMin=100, sMax=255, vMin=100, vMax=255),
+            SimpleNamespace(name='White', hMin=0, hMax=179, sMin=0, sMax=40, vMin=200, vMax=255)]
+
+
+# Write a Motion JPEG video of a yellow ball rolling past a white one on felt
+def write_video(filename, frames=60, size=(320, 240), fps=30):
+    w, h = size
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    for i in range(frames):
+        frame = np.zeros((h, w, 3), np.uint8)
+        frame[:] = (40, 110, 30)
+        cv2.circle(frame, (w // 4, h // 2), 14, (245, 245, 245), cv2.FILLED)
+        cv2.circle(frame, (w // 2 + i % (w // 3), h // 3), 14, (0, 220, 240), cv2.FILLED)
+        writer.write(frame)
+    writer.release()
+    return filename
+
+
+@pytest.fixture
+def video(tmp_path):
+    return write_video(str(tmp_path / 'table.avi'))
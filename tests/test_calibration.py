@@ -0,0 +1,21 @@
+import numpy as np
+from calibration import TableCalibration
+from physics import pockets
+
+
+def test_upright_table_is_rectified_lying_down():
+    # Mark a table standing upright in the camera image, with a spot near
+    # the middle of its right long rail
+    frame = np.zeros((400, 300, 3), np.uint8)
+    frame[195:205, 240:250] = 255
+    calibration = TableCalibration([(50, 0), (250, 0), (250, 399), (50, 399)])
+    assert calibration.width > calibration.height
+
+    table = calibration.rectify(frame)
+    h, w = table.shape[:2]
+    assert (w, h) == (calibration.width, calibration.height)
+    ys, xs = np.nonzero(table[:, :, 0])
+    # The long rail now runs along the bottom, past a side pocket
+    side = pockets(w, h)[4]
+    assert abs(xs.mean() - side[0]) < 10
+    assert ys.mean() > h * 0.8
@@ -0,0 +1,17 @@
+import time
+from planner import ShotPlanner
+from shotcache import ShotCache
+
+
+def test_shutdown_closes_the_cache_after_the_running_search(tmp_path):
+    cache = ShotCache(filename=str(tmp_path / 'shots.db'))
+    planner = ShotPlanner(workers=1, timeBudget=0.5, directions=8, cache=cache)
+    plan = planner.submit([(50, 50, 10), (150, 60, 10)], 300, 150, [0])
+    # Shut down in the middle of the search
+    time.sleep(0.2)
+    thread = planner.thread
+    planner.shutdown()
+    thread.shutdown(wait=True)
+    assert plan.done()
+    assert cache.db is None
+    assert not cache.pending
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+from calibration import TableCalibration
+from recorder import SessionRecorder, load_sidecar, recording_info, is_rectified
+
+
+def frame_count(filename):
+    video = cv2.VideoCapture(filename)
+    count = 0
+    while video.grab():
+        count += 1
+    video.release()
+    return count
+
+
+def test_size_and_calibration_changes_start_a_new_segment(tmp_path):
+    calibration = TableCalibration([(10, 10), (310, 10), (310, 230), (10, 230)], 300, 150)
+    recorder = SessionRecorder(str(tmp_path / 'game.avi'), 30, queueSize=64).start()
+    for i in range(10):
+        recorder.record(np.full((240, 320, 3), 60, np.uint8), i / 30)
+    # A frame no video can hold is dropped
+    recorder.record(np.zeros((240, 320), np.uint8), 10 / 30)
+    for i in range(10, 20):
+        recorder.record(np.full((150, 300, 3), 60, np.uint8), i / 30, calibration=calibration)
+    recorder.close()
+
+    assert recorder.stats() == {'written': 20, 'dropped': 1, 'segments': 2}
+    first, second = recorder.segments
+    assert first == str(tmp_path / 'game.avi')
+    assert second == str(tmp_path / 'game-1.avi')
+    for filename, rectified in ((first, False), (second, True)):
+        assert frame_count(filename) == 10
+        records = load_sidecar(filename)
+        assert [record['frame'] for record in records] == list(range(10))
+        assert is_rectified(filename) == rectified
+    assert recording_info(second)['calibration'] == calibration.toDict()
+    assert load_sidecar(second)[0]['time'] == 10 / 30
@@ -0,0 +1,49 @@
+import time
+import numpy as np
+from calibration import TableCalibration
+from server import TableServer
+from sources import FAST
+from conftest import write_video
+
+
+def run_tables(server, frames=10, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        server.poll(0.1)
+        if all(t.received >= frames or t.error for t in server.tables):
+            break
+
+
+def test_tables_run_with_and_without_calibration(tmp_path, ball_objects):
+    calibration = TableCalibration([(10, 10), (310, 10), (310, 230), (10, 230)], 300, 150)
+    calibrationFile = str(tmp_path / 'table0.json')
+    calibration.save(calibrationFile)
+    videos = [write_video(str(tmp_path / 'table{}.avi'.format(i))) for i in range(2)]
+
+    server = TableServer(videos, ball_objects, FAST, 1, [calibrationFile, None]).start()
+    try:
+        run_tables(server)
+        for table in server.tables:
+            assert table.error is None
+            assert table.received >= 10
+        assert server.frame(0).shape == (150, 300, 3)
+        assert server.frame(1).shape == (240, 320, 3)
+        assert len(server.tables[1].balls) == 2
+    finally:
+        server.stop()
+
+
+def test_shot_is_resolved_by_the_table(tmp_path, ball_objects):
+    server = TableServer([write_video(str(tmp_path / 'table.avi'))], ball_objects, FAST, 1).start()
+    try:
+        run_tables(server, 5)
+        ballId = server.tables[0].balls[0][0]
+        server.shot(0, ballId, (500, 0))
+        deadline = time.monotonic() + 20
+        while server.tables[0].shot is None and time.monotonic() < deadline:
+            server.poll(0.1)
+        ids, final, pocketed = server.tables[0].shot
+        assert ballId in ids
+        assert np.shape(final) == (len(ids), 2)
+    finally:
+        server.stop()
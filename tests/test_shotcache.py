@@ -0,0 +1,16 @@
+import sqlite3
+from shotcache import ShotCache
+
+
+def test_file_keeps_the_newest_outcomes(tmp_path):
+    filename = str(tmp_path / 'shots.db')
+    cache = ShotCache(filename=filename, dbSize=10)
+    for flush in range(3):
+        for k in range(8):
+            cache.put('shot{}'.format(flush * 8 + k), ([(k, k)], [None]))
+        cache.flush()
+    cache.close()
+
+    keys = {key for key, in sqlite3.connect(filename).execute("SELECT key FROM shots")}
+    assert keys == {'shot{}'.format(k) for k in range(14, 24)}
+    assert ShotCache(filename=filename).get('shot23') == ([(7, 7)], [None])
@@ -0,0 +1,82 @@
+import socket
+import threading
+import time
+import urllib.request
+import cv2
+import numpy as np
+from stream import MjpegStreamer, BOUNDARY
+
+
+# Count the frames a client receives over seconds, sleeping between reads if slow
+def watch(port, seconds, delay, counts, key):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=0.5)
+    sock.sendall(b"GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    received = b''
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            # Nothing more is published
+            break
+        if not data:
+            break
+        received += data
+        if delay:
+            time.sleep(delay)
+    sock.close()
+    counts[key] = received.count(('--' + BOUNDARY).encode())
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_frames_are_encoded_once_and_slow_clients_skip(monkeypatch):
+    encodes = []
+    imencode = cv2.imencode
+    monkeypatch.setattr(cv2, 'imencode', lambda *args: encodes.append(1) or imencode(*args))
+    streamer = MjpegStreamer('127.0.0.1', 0).start()
+    try:
+        counts = {}
+        clients = [threading.Thread(target=watch, args=(streamer.port, 2, 0.2 if i == 0 else 0,
+                                                        counts, i))
+                   for i in range(4)]
+        for client in clients:
+            client.start()
+        assert wait_for(lambda: streamer.clients == 4)
+
+        frame = np.zeros((240, 320, 3), np.uint8)
+        published = 0
+        end = time.monotonic() + 2
+        while time.monotonic() < end:
+            cv2.circle(frame, (published % 320, 120), 10, (0, 255, 255), cv2.FILLED)
+            streamer.publish(frame.copy())
+            published += 1
+            time.sleep(1 / 60)
+        for client in clients:
+            client.join()
+
+        assert len(encodes) == streamer.encoded <= published
+        fast = [counts[i] for i in range(1, 4)]
+        assert min(fast) > published / 4
+        assert counts[0] < min(fast)
+        assert wait_for(lambda: streamer.clients == 0)
+    finally:
+        streamer.stop()
+
+
+def test_nothing_is_encoded_without_clients():
+    streamer = MjpegStreamer('127.0.0.1', 0).start()
+    try:
+        for _ in range(10):
+            streamer.publish(np.zeros((48, 64, 3), np.uint8))
+        time.sleep(0.1)
+        assert streamer.encoded == 0
+        page = urllib.request.urlopen('http://127.0.0.1:{}/'.format(streamer.port)).read()
+        assert b'/stream' in page
+    finally:
+        streamer.stop()
@@ -0,0 +1,24 @@
+from timing import Profiler
+
+
+def test_stage_times_add_up_to_one_sample_per_frame():
+    profiler = Profiler(enabled=True)
+    for frame in range(3):
+        # Sixteen tracking windows per frame
+        for window in range(16):
+            profiler.add('hsv', 0.001)
+        profiler.add('render', 0.002)
+        profiler.frame()
+    summary = profiler.summary()
+    assert summary['hsv']['count'] == 3
+    assert abs(summary['hsv']['p50_ms'] - 16) < 1e-6
+    assert summary['render']['count'] == 3
+    assert summary['frame']['count'] == 2
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+    with profiler.stage('hsv'):
+        pass
+    profiler.frame()
+    assert profiler.summary() == {}
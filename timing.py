@@ -0,0 +1,148 @@
+import contextlib
+import csv
+import json
+import time
+from collections import deque
+import cv2
+import numpy as np
+
+# Samples kept per stage for the rolling percentiles
+WINDOW = 300
+PERCENTILES = (50, 95, 99)
+# Time between frames and from capture to display are recorded as stages too
+FRAME = 'frame'
+LATENCY = 'latency'
+OVERLAY_FONT = cv2.FONT_HERSHEY_SIMPLEX
+OVERLAY_COLOR = (255, 255, 255)
+
+# Shared do-nothing context returned by disabled timers
+NO_STAGE = contextlib.nullcontext()
+
+
+# Times one named stage into its profiler
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+# Rolling per-stage timings in seconds, one sample per stage per frame. A
+# stage that runs several times in a frame, like detection in every tracking
+# window, adds up until the frame is marked shown. When disabled every call
+# returns straight away, so the timers can stay in the frame loop.
+class Profiler:
+    def __init__(self, enabled=False, window=WINDOW, overlay=False):
+        self.enabled = enabled
+        self.window = window
+        self.overlay = overlay
+        self.samples = {}
+        self.counts = {}
+        self.pending = {}
+        self.lastFrame = None
+
+    def enable(self, enabled=True, overlay=False):
+        self.enabled = enabled
+        self.overlay = overlay
+        self.pending = {}
+        self.lastFrame = None
+
+    # with profiler.stage('hsv'): ...
+    def stage(self, name):
+        if not self.enabled:
+            return NO_STAGE
+        return Stage(self, name)
+
+    # Add time to a stage of the current frame
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        self.pending[name] = self.pending.get(name, 0.0) + seconds
+
+    # Record one sample of a stage
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+            self.counts[name] = 0
+        self.samples[name].append(seconds)
+        self.counts[name] += 1
+
+    # Mark a frame as shown and record the stage times it added up. captureTime
+    # is the time.monotonic() the frame was captured at, for the end-to-end latency.
+    def frame(self, captureTime=None):
+        if not self.enabled:
+            return
+        for name, seconds in self.pending.items():
+            self.record(name, seconds)
+        self.pending = {}
+        now = time.monotonic()
+        if self.lastFrame is not None:
+            self.record(FRAME, now - self.lastFrame)
+        self.lastFrame = now
+        if captureTime:
+            self.record(LATENCY, now - captureTime)
+
+    def fps(self):
+        intervals = self.samples.get(FRAME)
+        if not intervals:
+            return 0.0
+        mean = sum(intervals) / len(intervals)
+        return 1 / mean if mean > 0 else 0.0
+
+    # Count, mean, percentiles and max of every stage in milliseconds
+    def summary(self):
+        result = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                continue
+            values = np.array(samples) * 1000
+            stats = {'count': self.counts[name], 'mean_ms': float(values.mean())}
+            for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                stats['p{}_ms'.format(p)] = float(value)
+            stats['max_ms'] = float(values.max())
+            result[name] = stats
+        return result
+
+    # Write the summary to a .json file, or a .csv file with a row per stage
+    def export(self, filename):
+        summary = self.summary()
+        if filename.lower().endswith('.json'):
+            with open(filename, "w+") as file:
+                json.dump(summary, file, indent=2)
+            return
+        columns = ['count', 'mean_ms'] + ['p{}_ms'.format(p) for p in PERCENTILES] + ['max_ms']
+        with open(filename, "w+", newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['stage'] + columns)
+            for name, stats in summary.items():
+                writer.writerow([name] + [stats[column] for column in columns])
+
+    # Draw FPS and latency in the top left corner of a frame
+    def drawOverlay(self, frame):
+        if not (self.enabled and self.overlay):
+            return
+        latency = self.samples.get(LATENCY)
+        lines = ["FPS {:.1f}".format(self.fps())]
+        if latency:
+            values = np.array(latency) * 1000
+            lines.append("Latency {:.0f} ms (p95 {:.0f})".format(
+                np.percentile(values, 50), np.percentile(values, 95)))
+        for i, line in enumerate(lines):
+            cv2.putText(frame, line, (10, 25 + 25 * i), OVERLAY_FONT, 0.7,
+                        (0, 0, 0), 4, cv2.LINE_AA)
+            cv2.putText(frame, line, (10, 25 + 25 * i), OVERLAY_FONT, 0.7,
+                        OVERLAY_COLOR, 1, cv2.LINE_AA)
+
+
+# Shared profiler for the frame loop, disabled until the app enables it
+profiler = Profiler()